@@ -0,0 +1,9 @@
+#!/bin/bash
+# script used as PRE script of the rerun of the mille jobs in the speculative trend dag (see buildDag_Trend in createSubmitDAG.py)
+# takes output directory of the previous pede step as argument, exits with 0 if the pede step imported a new payload (mille jobs have to be rerun) and with 99 otherwise (rerun is skipped)
+if [ -f $1/payloadUpdated ]
+then
+    echo "New payload imported in $1, mille jobs are rerun"
+    exit 0
+fi
+exit 99
@@ -20,6 +20,8 @@ import csv
 import ROOT
 from ROOT import gPad, gStyle, gROOT
 
+from makeCombinedHists import readDQMFiles, selectInputHists, getRunFiles, ResultCache, stackInputHists, getCombinedValues, getHistLimits, getHistFromCounts, countBins, getHistArrays, getHistFromArrays, renderPlots, plotFolders, getPlotStyle
+
 # class defining the plotting parameters for different measures (e.g. movement) and different variables (e.g. Xpos)
 # the colors for different subdetectors are defined as well
 class Parameter:
@@ -61,6 +63,7 @@ parameters_sig = [ # significances
     Parameter("Zrot", "#Delta#theta_{z}/#sigma_{#Delta#theta_{z}}", 2.5, 0, -50, 50 )
     ]
 parDict = collections.OrderedDict( (p.name, p) for p in parameters )
+parDictSig = collections.OrderedDict( (p.name, p) for p in parameters_sig )
 objects = [    # define color for different subdetectors
     ("Disk-1", ROOT.kBlack),
     ("Disk-2", ROOT.kCyan),
@@ -151,185 +154,172 @@ def mergeOverflow(h,includeUnderflow):
         h.SetEntries(entries)
     return h
 
-# method to get histograms from list a given search path (returns multiple histograms per run and hit option)
-def getInputHists(searchPath):
-    hits = ["50Hits","100Hits","300Hits","500Hits"]
-    hists = {}
-    for hitOption in hits:      # loop over different hit options
-        hists[hitOption] = {}
-        for filename in glob.glob(searchPath.format(hitOption)):
-            runNr = runFromFilename(filename)
-            print runNr
-            path_in_file="DQMData/Run "+str(runNr)+"/AlCaReco/Run summary/SiPixelAli/"
-            newHists = {}
-            if runNr<=318877:       # currently used for debugging, should be changed to true if all runs in search path should be considered
-            #  ~if True:
-                for p in parameters:
-                    for structure in objects:
-                        histName=p.name+"_HG_"+structure[0]
-                        h = getFromFile(filename, path_in_file+histName)
-                        if h:
-                            newHists[histName] = h
-                if newHists: hists[hitOption][runNr] = newHists
-    #  ~return sortedDict(hists)
-    return hists
-    
-# method to produce one histogram for each combination of hitnumber, variable and subdetector from multiple runs
-def getCombinedHist(inputHists, minRun=-1):
+# method to get the input arrays of a list of studies given as (label, search path) pairs, returns {label: (runs, movement, error, nModules)} in the order of the studies (see stackInputHists)
+# the DQM files of all studies are read in one pass with a process pool and files shared by several studies are read only once,
+# with useCache only files which are new or changed since the last call are read (one ResultCache per search path)
+def getInputHists(studies, nProcesses=8, useCache=True, cacheDir="./resultCache"):
+    runFiles = collections.OrderedDict()
+    caches = {}
+    staleFiles = set()
+    for label, searchPath in studies:
+        if searchPath in runFiles: continue     # study with same input as previous study
+        runFiles[searchPath] = getRunFiles(searchPath)
+        if useCache:
+            caches[searchPath] = ResultCache(searchPath, cacheDir)
+            staleFiles.update(caches[searchPath].getStaleFiles(runFiles[searchPath]))
+        else:
+            staleFiles.update(runFiles[searchPath].values())
+    fileArrays = readDQMFiles(sorted(staleFiles), nProcesses)
+    arrays = {}
+    for searchPath in runFiles:
+        if useCache:
+            caches[searchPath].update(runFiles[searchPath], fileArrays)
+            caches[searchPath].save()
+            cache = caches[searchPath]
+            arrays[searchPath] = (cache.runs, cache.movement, cache.error, cache.nModules)
+        else:
+            inputHists = {}
+            for run, filename in runFiles[searchPath].iteritems():
+                newHists = selectInputHists(fileArrays.get(filename, {}))
+                if newHists: inputHists[run] = newHists
+            arrays[searchPath] = stackInputHists(inputHists)
+    return collections.OrderedDict((label, arrays[searchPath]) for label, searchPath in studies)
+
+# method to get the movement, error and significance of all used modules of all studies in the form of {label: {name: (movement, error, significance)}} (modules without movement are not used)
+def getStudyValues(studyInputs, minRun=-1):
+    return collections.OrderedDict((label, getCombinedValues(*arrays, minRun=minRun, skipZero=True)) for label, arrays in studyInputs.iteritems())
+
+# method to produce one histogram for each combination of variable, subdetector and study from the values of getStudyValues
+# first key defines structure and variable and second key defines the study (in the order of the studies)
+def getCombinedHist(studyValues):
     hists = {}
     hists_e = {}
     hists_sig = {}
-    for item in inputHists:     # loop over hitnumbers
-        hists[item] = {}
-        hists_e[item] = {}
-        hists_sig[item] = {}
-        inputHists_temp = sortedDict(dict((key,value) for key, value in inputHists[item].iteritems() if key >= minRun))
-        isbpix = False
-        islayer4 = False
-        for iRun, (runNr, hmap) in enumerate(inputHists_temp.iteritems()):      # loop over runs
-            print runNr
-            for hname, h in hmap.iteritems():       # loop over individual histograms
-                isbpix = hname.find("Layer")!=-1
-                islayer4 = hname.find("Layer4")!=-1
-                
-                # this part defines the lower and upper limits of the histograms
-                limit = 100
-                limit_e = 30
-                if isbpix==False and hname.find("Xrot")!=-1: 
-                    limit = 600
-                    limit_e = 400
-                elif isbpix==False and hname.find("Zrot")!=-1: 
-                    limit = 600
-                    limit_e = 200
-                elif hname.find("Yrot")!=-1: 
-                    limit=1000
-                    limit_e = 400
-                
-                hdefault = ROOT.TH1F("",";Movement;Entries",100,-limit,limit)
-                hdefault_e = ROOT.TH1F("",";Error;Entries",100,0,limit_e)
-                hdefault_sig = ROOT.TH1F("",";Error;Entries",100,-20,20)
-                if isbpix==False:
-                    if hname not in hists[item]:
-                        hists[item][hname] = hdefault.Clone()
-                        hists_e[item][hname] = hdefault_e.Clone()
-                        hists_sig[item][hname] = hdefault_sig.Clone()
-                    if h.GetBinContent(1)==0:
-                       failed = True 
-                       continue  #alignment did not finish successfull
-                    for bin in range(1,h.GetNbinsX()+1):
-                        c = h.GetBinContent(bin)
-                        if c==0: continue
-                        e = h.GetBinError(bin)
-                        hists[item][hname].Fill(c)
-                        hists_e[item][hname].Fill(e)
-                        hists_sig[item][hname].Fill(c/e if e>0 else 0)
-                else:   # results in bpix are separated in outer and inner ladders
-                    if hname+"_out" not in hists[item]:
-                        hists[item][hname+"_out"] = hdefault.Clone()
-                        hists_e[item][hname+"_out"] = hdefault_e.Clone()
-                        hists_sig[item][hname+"_out"] = hdefault_sig.Clone()
-                    if hname+"_in" not in hists[item]:
-                        hists[item][hname+"_in"] = hdefault.Clone()
-                        hists_e[item][hname+"_in"] = hdefault_e.Clone()
-                        hists_sig[item][hname+"_in"] = hdefault_sig.Clone()
-                    for bin in range(1,h.GetNbinsX()+1):
-                        c = h.GetBinContent(bin)
-                        if c==0: continue
-                        e = h.GetBinError(bin)
-                        i = 0
-                        if islayer4: i=1    # numbering of inner and outer ladders in layer4 is inverted
-                        if bin%2==i:
-                            hists[item][hname+"_out"].Fill(c)
-                            hists_e[item][hname+"_out"].Fill(e)
-                            hists_sig[item][hname+"_out"].Fill(c/e if e>0 else 0)     # avoid dividing by zero
-                        else:
-                            hists[item][hname+"_in"].Fill(c)
-                            hists_e[item][hname+"_in"].Fill(e)
-                            hists_sig[item][hname+"_in"].Fill(c/e if e>0 else 0)     # avoid dividing by zero
-    return changeAxisDict(hists),changeAxisDict(hists_e),changeAxisDict(hists_sig)      # change axis such that first key defines structure and variable and second key defines hit number
+    for label, values in studyValues.iteritems():     # loop over studies
+        for name, (c, e, sig) in values.iteritems():
+            limit, limit_e = getHistLimits(name)
+            hists.setdefault(name, collections.OrderedDict())[label] = getHistFromCounts(countBins(c,100,-limit,limit),100,-limit,limit,";Movement;Entries")
+            hists_e.setdefault(name, collections.OrderedDict())[label] = getHistFromCounts(countBins(e,100,0,limit_e),100,0,limit_e,";Error;Entries")
+            hists_sig.setdefault(name, collections.OrderedDict())[label] = getHistFromCounts(countBins(sig,100,-20,20),100,-20,20,";Error;Entries")
+    return hists,hists_e,hists_sig
+
+# method to get summary statistics for each combination of variable, subdetector and study from the values of getStudyValues (one dictionary per row)
+# fractions are given for modules above the threshold (cut) and veto of the movement and above the threshold of the significance
+def getSummary(studyValues):
+    summary = []
+    for label, values in studyValues.iteritems():
+        for name, (c, e, sig) in values.iteritems():
+            param = name.split("_")[0]
+            n = len(c)
+            summary.append(collections.OrderedDict([
+                ("name", name), ("study", label), ("entries", n),
+                ("meanMovement", c.mean() if n else 0.), ("rmsMovement", c.std() if n else 0.), ("medianError", np.median(e) if n else 0.),
+                ("fracAboveCut", np.mean(np.abs(c)>parDict[param].cut) if n else 0.),
+                ("fracAboveVeto", np.mean(np.abs(c)>parDict[param].veto) if n else 0.),
+                ("fracSigAboveCut", np.mean(np.abs(sig)>parDictSig[param].cut) if n else 0.),
+            ]))
+    return summary
+
+# method to write the summary statistics to a csv file
+def writeSummary(summary, fileName):
+    if not summary: return
+    if os.path.dirname(fileName) and not os.path.exists(os.path.dirname(fileName)):
+        os.makedirs(os.path.dirname(fileName))
+    with open(fileName, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=summary[0].keys())
+        writer.writeheader()
+        writer.writerows(summary)
+    print "Summary written to", fileName
+
+# method to draw the combined histograms of all studies for one structure and variable (job from drawCombinedHists) and save it with the given endings
+def drawComparisonHist(job, endings):
+    ih = job["kind"]
+    name = job["name"]
+    objectDict = {}
+    for structure in objects:
+        objectDict[structure[0]] = structure[1]
+    
+    paramDict = {}
+    parameters_temp = parameters
+    if ih==1 : parameters_temp=parameters_e     # get correct parameters
+    elif ih==2 : parameters_temp=parameters_sig
+    for param in parameters_temp:
+        paramDict[param.name] = param
+    gROOT.SetBatch(True)
+    line = ROOT.TLine()
+    line.SetLineStyle(2)
+    line_e = ROOT.TLine()
+    line_e.SetLineStyle(2)
+    line_e.SetLineColor(ROOT.kRed)
+    leg = ROOT.TLegend(.56, .76, .88, .88)
+    leg.SetNColumns(2)
+    leg.SetBorderSize(1)
+    leg.SetLineWidth(0)
+    gStyle.SetFrameLineWidth(2)
+    c = ROOT.TCanvas(randomName(),"",700,600)
+    hists = collections.OrderedDict()
+    isbpix = name.find("Layer")!=-1
+    structure = name.split("_")[2]      # get structure from name (e.g. Layer1)
+    param = name.split("_")[0]      # get histogram type from name (e.g. movement)
+    for io,(label,arrays) in enumerate(job["hists"]):       # loop over different studies
+        hist = mergeOverflow(getHistFromArrays(arrays),True)
+        hist.SetStats(0)
+        hist.SetTitle(";{};{}".format(paramDict[param].label,"Entries"))
+        gPad.SetLeftMargin(100)
+        hist.SetMarkerColor(objectDict[structure])
+        #  ~hist.SetLineColor(io+1 if io<=1 else io+2)
+        hist.SetLineColor(io+6 if len(job["hists"])<=4 else ROOT.TColor.GetColorPalette(io*ROOT.TColor.GetNumberOfColors()/len(job["hists"])))    # use color palette for many studies
+        hist.SetLineWidth(2)
+        hist.SetMaximum(1.3*hist.GetMaximum())
+        hist.Draw("hist" if io==0 else "hist same")     # draw all studies in the same plot
+        hist.GetYaxis().SetTitleOffset(0.95)
+        hists[label] = hist
+        #  ~leg.AddEntry(hist, label, "l")
+        leg.AddEntry(hist, label+"({})".format(int(hist.GetEntries())), "l")
+    gStyle.SetHistTopMargin(0.)
+    hist_temp=hists.itervalues().next()
+    if ih==0 or ih==2:  # show different thresholds/veto lines depending on the histogram type
+        line.DrawLine(-paramDict[param].cut, 0, -paramDict[param].cut,hist_temp.GetMaximum())
+        line.DrawLine(+paramDict[param].cut, 0, +paramDict[param].cut,hist_temp.GetMaximum())
+    if ih==0 or ih==1:
+        if ih==0: line_e.DrawLine(-paramDict[param].veto, 0, -paramDict[param].veto,hist_temp.GetMaximum())
+        line_e.DrawLine(+paramDict[param].veto, 0, +paramDict[param].veto,hist_temp.GetMaximum())
+    gPad.RedrawAxis()
+    text = ROOT.TLatex()
+    text.SetTextSize(0.04)
+    text.DrawLatexNDC(.1, .91, "#scale[1.2]{#font[61]{CMS}} #font[52]{Private Work}")
+    text.DrawLatexNDC(.6, .91, "2018 pp collisions")
+    text.DrawLatexNDC(.59, .645, structure+name.split("_")[3] if isbpix else structure)
+    leg.Draw();
+    save(name, job["folder"], endings=endings)
 
-# method to draw the combined histograms
-def drawCombinedHists(hmaps,plotDir):
+# method to draw the combined histograms (in parallel with nProcesses, only plots with changed content or style are drawn again, see renderPlots in makeCombinedHists.py)
+def drawCombinedHists(hmaps,plotDir,endings=[".pdf",".root"],nProcesses=8,force=False):
+    jobs = []
     for ih,hmap in enumerate(hmaps):    # ih loops over movement, error and significance hists
-        objectDict = {}
-        for structure in objects:
-            objectDict[structure[0]] = structure[1]
-        
-        paramDict = {}
-        parameters_temp = parameters
-        if ih==1 : parameters_temp=parameters_e     # get correct parameters
-        elif ih==2 : parameters_temp=parameters_sig
-        for param in parameters_temp:
-            paramDict[param.name] = param
-        if not hmap: return
-        gROOT.SetBatch(True)
-        line = ROOT.TLine()
-        line.SetLineStyle(2)
-        line_e = ROOT.TLine()
-        line_e.SetLineStyle(2)
-        line_e.SetLineColor(ROOT.kRed)
-        leg = ROOT.TLegend(.56, .76, .88, .88)
-        leg.SetNColumns(2)
-        leg.SetBorderSize(1)
-        leg.SetLineWidth(0)
-        gStyle.SetFrameLineWidth(2)
-        c = ROOT.TCanvas(randomName(),"",700,600)
-        hists = {}
-        isbpix = False
-        for ig,(name,histCollection) in enumerate(hmap.iteritems()):      # ig loops over the combination of different detector parts and variables
-            hists[ig] = {}
-            isbpix = name.find("Layer")!=-1
-            structure = name.split("_")[2]      # get structure from name (e.g. Layer1)
-            param = name.split("_")[0]      # get histogram type from name (e.g. movement)
-            for io,histOption in enumerate(["50Hits","100Hits","300Hits","500Hits"]):       # loop over different hit options
-                hist = mergeOverflow(histCollection[histOption],True)
-                hist.SetStats(0)
-                hist.SetTitle(";{};{}".format(paramDict[param].label,"Entries"))
-                gPad.SetLeftMargin(100)
-                hist.SetMarkerColor(objectDict[structure])
-                #  ~hist.SetLineColor(io+1 if io<=1 else io+2)
-                hist.SetLineColor(io+6)
-                hist.SetLineWidth(2)
-                hist.SetMaximum(1.3*hist.GetMaximum())
-                hist.Draw("hist" if io==0 else "hist same")     # draw all hit option in the same plot
-                hist.GetYaxis().SetTitleOffset(0.95)
-                hists[ig][histOption] = hist.Clone()
-                #  ~leg.AddEntry(hist, histOption, "l")
-                leg.AddEntry(hist, histOption+"({})".format(int(hist.GetEntries())), "l")
-            gStyle.SetHistTopMargin(0.)
-            hist_temp=hists[ig].itervalues().next()
-            if ih==0 or ih==2:  # show different thresholds/veto lines depending on the histogram type
-                line.DrawLine(-paramDict[param].cut, 0, -paramDict[param].cut,hist_temp.GetMaximum())
-                line.DrawLine(+paramDict[param].cut, 0, +paramDict[param].cut,hist_temp.GetMaximum())
-            if ih==0 or ih==1:
-                if ih==0: line_e.DrawLine(-paramDict[param].veto, 0, -paramDict[param].veto,hist_temp.GetMaximum())
-                line_e.DrawLine(+paramDict[param].veto, 0, +paramDict[param].veto,hist_temp.GetMaximum())
-            gPad.RedrawAxis()
-            text = ROOT.TLatex()
-            text.SetTextSize(0.04)
-            text.DrawLatexNDC(.1, .91, "#scale[1.2]{#font[61]{CMS}} #font[52]{Private Work}")
-            text.DrawLatexNDC(.6, .91, "2018 pp collisions")
-            text.DrawLatexNDC(.59, .645, structure+name.split("_")[3] if isbpix else structure)
-            leg.Draw();
-            if ih==0 : save(name, plotDir+"/movements", endings=[".pdf",".root"])
-            elif ih==1 : save(name, plotDir+"/errors", endings=[".pdf",".root"])
-            else : save(name, plotDir+"/significance", endings=[".pdf",".root"])
-            c.Clear()
-            leg.Clear()
+        for name,histCollection in hmap.iteritems():      # loops over the combination of different detector parts and variables
+            jobs.append({"kind": ih, "name": name, "folder": os.path.join(plotDir, plotFolders[ih]),
+                         "hists": [(label, getHistArrays(hist)) for label,hist in histCollection.iteritems()]})
+    renderPlots(drawComparisonHist, jobs, plotDir, getPlotStyle([parameters,parameters_e,parameters_sig], objects, mergeOverflow), endings, nProcesses, force)
 
 if __name__ == "__main__":
     #########Define the output directory#############
     plotDir = "./plots/PR_starting_2018B_diffHits"
 
-    #########Define path of histograms###############
+    #########Define studies to compare as (label, path of histograms)###############
     searchPath="/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/2018B_PRstartingGeometry_iterativ_diffHits/{}/HG_run*/DQM*.root"
     #  ~searchPath="/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/2018B_PRstartingGeometry_iterativ_diffHits/{}/HG_run31708*/DQM*.root"
+    studies = [(hitOption, searchPath.format(hitOption)) for hitOption in ["50Hits","100Hits","300Hits","500Hits"]]
+    #  ~studies = [("HG", "/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/output/HG_run*/DQM*.root"),
+    #  ~           ("PR start", "/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/2018B_PRstartingGeometry/HG_run*/DQM*.root")]
     
-    # get input histograms from one DQM file per run
-    inputHists = getInputHists(searchPath)
+    # get input arrays of all studies from one DQM file per run
+    studyInputs = getInputHists(studies)
     
-    # prepare combined histograms from multiple runs
-    combinedHists = getCombinedHist(inputHists)
+    # prepare combined histograms and summary statistics from multiple runs
+    studyValues = getStudyValues(studyInputs)
+    combinedHists = getCombinedHist(studyValues)
+    writeSummary(getSummary(studyValues), plotDir+"/summary.csv")
     
     # draw combined histograms
     drawCombinedHists(combinedHists,plotDir)
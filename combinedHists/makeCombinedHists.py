@@ -16,6 +16,9 @@ import json
 import ast
 import sys
 import csv
+import multiprocessing
+import hashlib
+import inspect
 
 import ROOT
 from ROOT import gPad, gStyle, gROOT
@@ -74,6 +77,9 @@ objects = [    # define color for different subdetectors
     ("Layer4", ROOT.kOrange),
 ]
 
+# output folder of the movement, error and significance plots in the plot directory
+plotFolders = ["movements","errors","significance"]
+
 # method to save plots and create saving path if not exists
 def save(name, folder="plots", endings=[".pdf"]):
     if not os.path.exists(folder):
@@ -139,28 +145,163 @@ def mergeOverflow(h,includeUnderflow):
         h.SetEntries(entries)
     return h
 
-# method to get histograms from list a given search path (returns multiple histograms per run)
-def getInputHists(searchPath):
+# method to read all HG histograms of a DQM file in one pass (file is opened once), returns filename and {histName: (bin contents, bin errors)} (None if file is empty)
+def readDQMFile(filename):
+    runNr = runFromFilename(filename)
+    f = ROOT.TFile.Open(filename)
+    if not f:
+        return filename, None
+    try:
+        if f.GetSize()<5000: # DQM files sometimes are empty
+            return filename, None
+        arrays = {}
+        directory = f.Get("DQMData/Run "+str(runNr)+"/AlCaReco/Run summary/SiPixelAli")
+        if directory:
+            for key in directory.GetListOfKeys():
+                if key.GetName().find("_HG_")==-1: continue
+                h = key.ReadObj()
+                if not h.InheritsFrom("TH1"): continue
+                bins = range(1,h.GetNbinsX()+1)
+                arrays[key.GetName()] = (np.array([h.GetBinContent(bin) for bin in bins]), np.array([h.GetBinError(bin) for bin in bins]))
+    finally:    # file is closed also for empty files, otherwise each pool worker keeps the handles open
+        f.Close()
+    return filename, arrays
+
+# method to read the HG histograms of many DQM files with a process pool, returns {filename: {histName: (bin contents, bin errors)}} (empty files are skipped)
+def readDQMFiles(filenames, nProcesses=8):
+    results = {}
+    if nProcesses>1 and len(filenames)>1:
+        pool = multiprocessing.Pool(min(nProcesses,len(filenames)))
+        fileArrays = pool.imap_unordered(readDQMFile, filenames)
+    else:
+        pool = None
+        fileArrays = (readDQMFile(filename) for filename in filenames)
+    for filename, arrays in fileArrays:
+        print runFromFilename(filename)
+        if arrays is not None: results[filename] = arrays
+    if pool:
+        pool.close()
+        pool.join()
+    return results
+
+# method to get the histograms of all parameters and structures from the arrays of one DQM file in the form of {histName: (bin contents, bin errors)}
+def selectInputHists(arrays):
+    newHists = {}
+    for p in parameters:
+        for structure in objects:
+            histName=p.name+"_HG_"+structure[0]
+            if histName in arrays:
+                newHists[histName] = arrays[histName]
+    return newHists
+
+# class storing the results of all runs of a study (one DQM file per run) as dense arrays of run x structure x parameter x module for movement and error
+# (modules not present in a structure are NaN), the size and modification time of the DQM file of each run are stored to only read new or changed files
+class ResultCache:
+    def __init__(self, searchPath, cacheDir="./resultCache"):
+        self.searchPath = searchPath
+        self.fileName = os.path.join(cacheDir, hashlib.sha1(searchPath).hexdigest()[:16]+".npz")     # one cache per study
+        self.structures = [structure[0] for structure in objects]
+        self.params = [p.name for p in parameters]
+        self.runs = np.zeros(0, dtype=np.int64)
+        self.fileSizes = np.zeros(0, dtype=np.int64)
+        self.fileTimes = np.zeros(0)
+        self.movement = np.zeros((0,len(self.structures),len(self.params),0))
+        self.error = np.zeros((0,len(self.structures),len(self.params),0))
+        self.nModules = np.zeros((0,len(self.structures),len(self.params)), dtype=np.int32)     # number of modules of each histogram (0 if missing)
+        if os.path.exists(self.fileName):
+            cache = np.load(self.fileName)
+            if list(cache["structures"])==self.structures and list(cache["params"])==self.params:     # layout changed, cache is rebuilt
+                for name in ("runs","fileSizes","fileTimes","movement","error","nModules"):
+                    setattr(self, name, cache[name])
+    
+    # method to get the DQM files which are not in the cache or changed since they were cached (given as {run: filename})
+    def getStaleFiles(self, runFiles):
+        cached = dict((run,i) for i,run in enumerate(self.runs))
+        stale = []
+        for run, filename in runFiles.iteritems():
+            i = cached.get(run)
+            if i is None or os.path.getsize(filename)!=self.fileSizes[i] or os.path.getmtime(filename)!=self.fileTimes[i]:
+                stale.append(filename)
+        return stale
+    
+    # method to update the cache with the arrays read from the DQM files ({filename: {histName: (contents, errors)}}), runs not in runFiles are removed
+    # new or changed files missing in fileArrays (empty DQM files) are stored without histograms together with their size and modification time, so they are only read again if they change
+    def update(self, runFiles, fileArrays):
+        stale = set(self.getStaleFiles(runFiles))
+        keep = np.array([run in runFiles and runFiles[run] not in fileArrays and runFiles[run] not in stale for run in self.runs], dtype=bool)
+        keptRuns = set(self.runs[keep])
+        newRuns = sorted(run for run in runFiles if run not in keptRuns)
+        width = max([self.movement.shape[3]]+[len(contents) for arrays in fileArrays.itervalues() for contents,errors in arrays.itervalues()])
+        shape = (len(newRuns),len(self.structures),len(self.params))
+        movement = np.full(shape+(width,), np.nan)
+        error = np.full(shape+(width,), np.nan)
+        nModules = np.zeros(shape, dtype=np.int32)
+        for i, run in enumerate(newRuns):
+            arrays = fileArrays.get(runFiles[run], {})
+            for s, structure in enumerate(self.structures):
+                for p, param in enumerate(self.params):
+                    histName = param+"_HG_"+structure
+                    if histName in arrays:
+                        contents, errors = arrays[histName]
+                        movement[i,s,p,:len(contents)] = contents
+                        error[i,s,p,:len(errors)] = errors
+                        nModules[i,s,p] = len(contents)
+        pad = ((0,0),(0,0),(0,0),(0,width-self.movement.shape[3]))
+        self.movement = np.concatenate((np.pad(self.movement[keep],pad,"constant",constant_values=np.nan),movement))
+        self.error = np.concatenate((np.pad(self.error[keep],pad,"constant",constant_values=np.nan),error))
+        self.nModules = np.concatenate((self.nModules[keep],nModules))
+        self.fileSizes = np.concatenate((self.fileSizes[keep],np.array([os.path.getsize(runFiles[run]) for run in newRuns], dtype=np.int64)))
+        self.fileTimes = np.concatenate((self.fileTimes[keep],np.array([os.path.getmtime(runFiles[run]) for run in newRuns])))
+        self.runs = np.concatenate((self.runs[keep],np.array(newRuns, dtype=np.int64)))
+        order = np.argsort(self.runs)       # runs are kept sorted
+        for name in ("runs","fileSizes","fileTimes","movement","error","nModules"):
+            setattr(self, name, getattr(self, name)[order])
+    
+    # method to write the cache (uncompressed, so it can be loaded in milliseconds)
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.fileName)):
+            os.makedirs(os.path.dirname(self.fileName))
+        with open(self.fileName+".tmp","wb") as f:
+            np.savez(f, searchPath=self.searchPath, structures=self.structures, params=self.params, runs=self.runs, fileSizes=self.fileSizes,
+                     fileTimes=self.fileTimes, movement=self.movement, error=self.error, nModules=self.nModules)
+        os.rename(self.fileName+".tmp", self.fileName)
+    
+    # method to get the histograms of all runs in the form of {run: {histName: (bin contents, bin errors)}} (runs without histograms are skipped)
+    def getInputHists(self):
+        hists = {}
+        for i, run in enumerate(self.runs):
+            newHists = {}
+            for s, structure in enumerate(self.structures):
+                for p, param in enumerate(self.params):
+                    n = self.nModules[i,s,p]
+                    if n: newHists[param+"_HG_"+structure] = (self.movement[i,s,p,:n], self.error[i,s,p,:n])
+            if newHists: hists[int(run)] = newHists
+        return sortedDict(hists)
+
+# method to get the DQM file of each run for a given search path in the form of {run: filename}
+def getRunFiles(searchPath):
+    return dict((runFromFilename(filename),filename) for filename in sorted(glob.glob(searchPath)) if runFromFilename(filename)<=318877)   # currently used for debugging, should be changed to true if all runs in search path should be considered
+    #  ~return dict((runFromFilename(filename),filename) for filename in sorted(glob.glob(searchPath)))
+
+# method to get histograms from list a given search path (returns multiple histograms per run as arrays of bin contents and errors)
+# with useCache only DQM files which are new or changed since the last call are read, the results of the study are stored in a ResultCache in cacheDir
+def getInputHists(searchPath, nProcesses=8, useCache=True, cacheDir="./resultCache"):
+    runFiles = getRunFiles(searchPath)
+    if useCache:
+        cache = ResultCache(searchPath, cacheDir)
+        staleFiles = cache.getStaleFiles(runFiles)
+        print len(runFiles)-len(staleFiles),"of",len(runFiles),"runs taken from cache"
+        cache.update(runFiles, readDQMFiles(staleFiles, nProcesses))
+        cache.save()
+        return cache.getInputHists()
     hists = {}
-    for filename in glob.glob(searchPath):
-        runNr = runFromFilename(filename)
-        #  ~if runNr!=317182: continue
-        print runNr
-        path_in_file="DQMData/Run "+str(runNr)+"/AlCaReco/Run summary/SiPixelAli/"
-        newHists = {}
-        if runNr<=318877:       # currently used for debugging, should be changed to true if all runs in search path should be considered
-        #  ~if True:
-            for p in parameters:
-                for structure in objects:
-                    histName=p.name+"_HG_"+structure[0]
-                    h = getFromFile(filename, path_in_file+histName)
-                    if h:
-                        newHists[histName] = h
-            if newHists: hists[runNr] = newHists
+    for filename, arrays in readDQMFiles(runFiles.values(), nProcesses).iteritems():
+        newHists = selectInputHists(arrays)
+        if newHists: hists[runFromFilename(filename)] = newHists
     return sortedDict(hists)
 
-# method to produce one histogram per variable and subdetector from multiple runs
-def getCombinedHist(inputHists, minRun=-1):
+# method to produce one histogram per variable and subdetector from multiple runs (with skipZero modules without movement are not used)
+def getCombinedHist(inputHists, minRun=-1, skipZero=False):
     inputHists = sortedDict(dict((key,value) for key, value in inputHists.iteritems() if key >= minRun))
     hists = {}
     hists_e = {}
@@ -169,7 +310,7 @@ def getCombinedHist(inputHists, minRun=-1):
     islayer4 = False
     for iRun, (runNr, hmap) in enumerate(inputHists.iteritems()):
         print runNr
-        for hname, h in hmap.iteritems():
+        for hname, (contents, errors) in hmap.iteritems():
             isbpix = hname.find("Layer")!=-1
             islayer4 = hname.find("Layer4")!=-1
             
@@ -194,12 +335,11 @@ def getCombinedHist(inputHists, minRun=-1):
                     hists[hname] = hdefault.Clone()
                     hists_e[hname] = hdefault_e.Clone()
                     hists_sig[hname] = hdefault_sig.Clone()
-                if h.GetBinContent(1)==0:
+                if contents[0]==0:
                    failed = True 
                    continue  #alignment did not finish successfull
-                for bin in range(1,h.GetNbinsX()+1):
-                    c = h.GetBinContent(bin)
-                    e = h.GetBinError(bin)
+                for c,e in zip(contents,errors):
+                    if skipZero and c==0: continue
                     hists[hname].Fill(c)
                     hists_e[hname].Fill(e)
                     hists_sig[hname].Fill(c/e if e>0 else 0)
@@ -212,9 +352,8 @@ def getCombinedHist(inputHists, minRun=-1):
                     hists[hname+"_in"] = hdefault.Clone()
                     hists_e[hname+"_in"] = hdefault_e.Clone()
                     hists_sig[hname+"_in"] = hdefault_sig.Clone()
-                for bin in range(1,h.GetNbinsX()+1):
-                    c = h.GetBinContent(bin)
-                    e = h.GetBinError(bin)
+                for bin,(c,e) in enumerate(zip(contents,errors),1):
+                    if skipZero and c==0: continue
                     i = 0
                     if islayer4: i=1    # numbering of inner and outer ladders in layer4 is inverted
                     if bin%2==i:
@@ -227,77 +366,303 @@ def getCombinedHist(inputHists, minRun=-1):
                         hists_sig[hname+"_in"].Fill(c/e if e>0 else 0)      # avoid dividing by zero
     return hists,hists_e,hists_sig
 
-# method to draw the combined histograms
-def drawCombinedHists(hmaps,plotDir):
-    for ih,hmap in enumerate(hmaps):    # ih loops over movement, error and significance hists
-        objectDict = {}
+# method to get the lower and upper limits of the combined movement and error histograms of a given input histogram (same as in getCombinedHist)
+def getHistLimits(hname):
+    isbpix = hname.find("Layer")!=-1
+    limit = 100
+    limit_e = 30
+    if isbpix==False and hname.find("Xrot")!=-1: 
+        limit = 600
+        limit_e = 400
+    elif isbpix==False and hname.find("Zrot")!=-1: 
+        limit = 600
+        limit_e = 200
+    elif hname.find("Yrot")!=-1: 
+        limit=1000
+        limit_e = 400
+    return limit, limit_e
+
+# method to stack the input histograms of all runs ({run: {histName: (contents, errors)}}) to arrays of run x structure x parameter x module (same layout as ResultCache)
+# returns runs, movement, error and number of modules of each histogram
+def stackInputHists(inputHists):
+    runs = np.array(sorted(inputHists), dtype=np.int64)
+    width = max([0]+[len(contents) for hmap in inputHists.itervalues() for contents,errors in hmap.itervalues()])
+    shape = (len(runs),len(objects),len(parameters))
+    movement = np.full(shape+(width,), np.nan)
+    error = np.full(shape+(width,), np.nan)
+    nModules = np.zeros(shape, dtype=np.int32)
+    for i, run in enumerate(runs):
+        for s, structure in enumerate(objects):
+            for p, param in enumerate(parameters):
+                histName = param.name+"_HG_"+structure[0]
+                if histName in inputHists[run]:
+                    contents, errors = inputHists[run][histName]
+                    movement[i,s,p,:len(contents)] = contents
+                    error[i,s,p,:len(errors)] = errors
+                    nModules[i,s,p] = len(contents)
+    return runs, movement, error, nModules
+
+# method to get the bin counts (including underflow and overflow) of the given values for a histogram with nBins between xmin and xmax, using the bin finding of TAxis::FindBin (NaN goes to the overflow)
+def countBins(values, nBins, xmin, xmax):
+    bins = np.full(values.shape, nBins+1, dtype=np.int64)
+    bins[values<xmin] = 0
+    inRange = (values>=xmin) & (values<xmax)
+    bins[inRange] = 1+(nBins*(values[inRange]-xmin)/(xmax-xmin)).astype(np.int64)
+    return np.bincount(bins, minlength=nBins+2)
+
+# method to get a TH1F with given bin counts (including underflow and overflow), which is identical to filling the histogram with the counted values
+def getHistFromCounts(counts, nBins, xmin, xmax, title):
+    h = ROOT.TH1F("",title,nBins,xmin,xmax)
+    for bin, count in enumerate(counts):
+        if count:
+            h.SetBinContent(bin,count)
+            h.SetBinError(bin,np.sqrt(count))
+    h.SetEntries(counts.sum())
+    return h
+
+# method to get the movement, error and significance of all used modules of all runs per variable and subdetector in the form of {name: (movement, error, significance)} (takes the output of stackInputHists or the arrays of a ResultCache)
+# bpix modules are split in outer and inner ladders by slicing (odd modules are outer ladders, even modules in layer4), with skipZero modules without movement are not used
+def getCombinedValues(runs, movement, error, nModules, minRun=-1, skipZero=False):
+    selected = runs>=minRun
+    movement = movement[selected]
+    error = error[selected]
+    nModules = nModules[selected]
+    valid = np.arange(movement.shape[3])<nModules[...,np.newaxis]     # modules present in the histogram of each run
+    values = collections.OrderedDict()
+    for s, structure in enumerate(objects):
+        for p, param in enumerate(parameters):
+            hname = param.name+"_HG_"+structure[0]
+            if not nModules[:,s,p].any(): continue
+            c = movement[:,s,p]
+            e = error[:,s,p]
+            used = valid[:,s,p].copy()
+            if skipZero: used &= c!=0
+            isbpix = hname.find("Layer")!=-1
+            if isbpix==False:
+                used &= (c[:,:1]!=0)      # alignment did not finish successfull
+                parts = [(hname, slice(None))]
+            elif hname.find("Layer4")!=-1:      # numbering of inner and outer ladders in layer4 is inverted
+                parts = [(hname+"_out", slice(0,None,2)), (hname+"_in", slice(1,None,2))]
+            else:
+                parts = [(hname+"_out", slice(1,None,2)), (hname+"_in", slice(0,None,2))]
+            for name, modules in parts:
+                mask = used[:,modules]
+                c_part = c[:,modules][mask]
+                e_part = e[:,modules][mask]
+                sig = np.divide(c_part, e_part, out=np.zeros_like(c_part), where=e_part>0)      # avoid dividing by zero
+                values[name] = (c_part, e_part, sig)
+    return values
+
+# method to produce one histogram per variable and subdetector from the arrays of all runs (vectorized version of getCombinedHist, same arguments as getCombinedValues)
+def getCombinedHistVectorized(runs, movement, error, nModules, minRun=-1, skipZero=False):
+    hists = {}
+    hists_e = {}
+    hists_sig = {}
+    for name, (c, e, sig) in getCombinedValues(runs, movement, error, nModules, minRun, skipZero).iteritems():
+        limit, limit_e = getHistLimits(name)
+        hists[name] = getHistFromCounts(countBins(c,100,-limit,limit),100,-limit,limit,";Movement;Entries")
+        hists_e[name] = getHistFromCounts(countBins(e,100,0,limit_e),100,0,limit_e,";Error;Entries")
+        hists_sig[name] = getHistFromCounts(countBins(sig,100,-20,20),100,-20,20,";Error;Entries")
+    return hists,hists_e,hists_sig
+
+# method to check that the vectorized and the ROOT version of getCombinedHist give identical histograms (all bins including underflow and overflow and number of entries), returns True if identical
+def checkCombinedHistVectorized(inputHists, minRun=-1, skipZero=False):
+    reference = getCombinedHist(inputHists, minRun, skipZero)
+    vectorized = getCombinedHistVectorized(*stackInputHists(inputHists), minRun=minRun, skipZero=skipZero)
+    identical = True
+    for kind, hmap, hmap_vectorized in zip(["movement","error","significance"], reference, vectorized):
+        if sorted(hmap)!=sorted(hmap_vectorized):
+            print "Different histograms for",kind,":",sorted(set(hmap)^set(hmap_vectorized))
+            identical = False
+            continue
+        for name in hmap:
+            h, h_vectorized = hmap[name], hmap_vectorized[name]
+            contents = [h.GetBinContent(bin) for bin in range(h.GetNbinsX()+2)]
+            contents_vectorized = [h_vectorized.GetBinContent(bin) for bin in range(h_vectorized.GetNbinsX()+2)]
+            if contents!=contents_vectorized or h.GetEntries()!=h_vectorized.GetEntries():
+                print "Different",kind,"histogram",name
+                identical = False
+    print "Vectorized combined histograms are","identical" if identical else "different"
+    return identical
+
+# method to get synthetic input histograms of several runs in the form of {run: {histName: (contents, errors)}} covering the special cases of getCombinedHist
+# (failed runs with empty first module, modules without movement or error, values on bin edges and outside of the histograms, different number of modules and missing histograms)
+def getSyntheticInputHists(nRuns=30, seed=1):
+    random = np.random.RandomState(seed)
+    inputHists = {}
+    for run in range(317000, 317000+nRuns):
+        inputHists[run] = {}
         for structure in objects:
-            objectDict[structure[0]] = structure[1]
-        
-        paramDict = {}
-        parameters_temp = parameters
-        if ih==1 : parameters_temp=parameters_e     # get correct parameters
-        elif ih==2 : parameters_temp=parameters_sig
-        for param in parameters_temp:
-            paramDict[param.name] = param
-        if not hmap: return
-        gROOT.SetBatch(True)
-        line = ROOT.TLine()
-        line.SetLineStyle(2)
-        line_e = ROOT.TLine()
-        line_e.SetLineStyle(2)
-        line_e.SetLineColor(ROOT.kRed)
-        leg = ROOT.TLegend(.61, .78, .969, .929)
-        leg.SetNColumns(2)
-        leg.SetBorderSize(1)
-        leg.SetLineWidth(2)
-        #  ~leg.AddEntry(line, "Threshold", "l")
-        gStyle.SetFrameLineWidth(2)
-        c = ROOT.TCanvas(randomName(),"",700,600)
-        hists = {}
-        isbpix = False
-        for ig,(name,hist) in enumerate(hmap.iteritems()):      # ig loops over the combination of different detector parts and variables
-            print name
-            isbpix = name.find("Layer")!=-1
-            structure = name.split("_")[2]      # get structure from name (e.g. Layer1)
-            param = name.split("_")[0]      # get histogram type from name (e.g. movement)
-            hist = mergeOverflow(hist,True)
-            hists[ig] = hist.Clone()
-            hists[ig].SetStats(0)
-            hists[ig].SetTitle(";{};{}".format(paramDict[param].label,"Entries"))
-            gPad.SetLeftMargin(100)
-            hists[ig].SetMarkerColor(objectDict[structure])
-            hists[ig].SetLineColor(objectDict[structure])
-            hists[ig].SetLineWidth(2)
-            hists[ig].SetMaximum(1.3*hists[ig].GetMaximum())
-            hists[ig].Draw("hist")
-            hists[ig].GetYaxis().SetTitleOffset(0.95)
-            gStyle.SetHistTopMargin(0.)
-            if ih==0 or ih==2:  # show different thresholds/veto lines depending on the histogram type
-                line.DrawLine(-paramDict[param].cut, 0, -paramDict[param].cut,hists[ig].GetMaximum())
-                line.DrawLine(+paramDict[param].cut, 0, +paramDict[param].cut,hists[ig].GetMaximum())
-            if ih==0 or ih==1:
-                if ih==0: line_e.DrawLine(-paramDict[param].veto, 0, -paramDict[param].veto,hists[ig].GetMaximum())
-                line_e.DrawLine(+paramDict[param].veto, 0, +paramDict[param].veto,hists[ig].GetMaximum())
-            gPad.RedrawAxis()
-            text = ROOT.TLatex()
-            text.SetTextSize(0.04)
-            text.DrawLatexNDC(.1, .91, "#scale[1.2]{#font[61]{CMS}} #font[52]{Private Work}")
-            text.DrawLatexNDC(.6, .91, "2018 pp collisions")
-            text.DrawLatexNDC(.59, .645, structure+name.split("_")[3] if isbpix else structure)
-            if ih!=1:       # show different percentages depending on the histogram type
-                text.DrawLatexNDC(.55, .445, "{:3.0f} % above update threshold".format(100*(hists[ig].Integral(0,hists[ig].GetXaxis().FindBin(-paramDict[param].cut)-1)+hists[ig].Integral(hists[ig].GetXaxis().FindBin(+paramDict[param].cut),hists[ig].GetNbinsX()+1))/hists[ig].GetEntries()))
-            if (ih==0 and paramDict[param].veto<hists[ig].GetXaxis().GetXmax()):
-                text.DrawLatexNDC(.55, .345, "{:3.0f} % above veto threshold".format(100*(hists[ig].Integral(0,hists[ig].GetXaxis().FindBin(-paramDict[param].veto)-1)+hists[ig].Integral(hists[ig].GetXaxis().FindBin(+paramDict[param].veto),hists[ig].GetNbinsX()+1))/hists[ig].GetEntries()))
-            elif (ih==1 and paramDict[param].veto<hists[ig].GetXaxis().GetXmax()):
-                text.DrawLatexNDC(.55, .345, "{:3.0f} % above veto threshold".format(100*hists[ig].Integral(hists[ig].GetXaxis().FindBin(+paramDict[param].veto),hists[ig].GetNbinsX()+1)/hists[ig].GetEntries()))
-            if ih==0 : save(name, plotDir+"/movements", endings=[".pdf",".root"])
-            elif ih==1 : save(name, plotDir+"/errors", endings=[".pdf",".root"])
-            else : save(name, plotDir+"/significance", endings=[".pdf",".root"])
-            c.Clear()
-            leg.Clear()
+            for p in parameters:
+                hname = p.name+"_HG_"+structure[0]
+                if random.rand()<0.05: continue     # histogram missing in this run
+                limit, limit_e = getHistLimits(hname)
+                n = random.randint(6, 13)
+                contents = np.round(random.normal(0, limit/2., n), random.randint(0, 4))
+                errors = np.abs(np.round(random.normal(0, limit_e/2., n), 1))
+                edges = np.linspace(-limit, limit, 101)
+                onEdge = random.rand(n)<0.2
+                contents[onEdge] = random.choice(edges, onEdge.sum())      # values on bin edges (including lower and upper limit)
+                contents[random.rand(n)<0.1] = random.choice([-2*limit, 2*limit])     # underflow and overflow
+                contents[random.rand(n)<0.2] = 0        # modules without movement
+                errors[random.rand(n)<0.2] = 0      # modules without error (significance set to zero)
+                if random.rand()<0.2: contents[0] = 0     # failed alignment in fpix, used in bpix
+                inputHists[run][hname] = (contents, errors)
+    return inputHists
+
+# method to check getCombinedHistVectorized against getCombinedHist on synthetic input (used by python makeCombinedHists.py --check), returns True if all histograms are identical
+def checkCombinedHistSynthetic():
+    inputHists = getSyntheticInputHists()
+    identical = True
+    for minRun in (-1, 317010):
+        for skipZero in (False, True):
+            print "Checking minRun",minRun,"skipZero",skipZero
+            identical &= checkCombinedHistVectorized(inputHists, minRun, skipZero)
+    return identical
+
+# method to get binning, bin contents and errors (including underflow and overflow) and entries of a histogram, which can be passed to other processes and hashed
+def getHistArrays(h):
+    bins = range(h.GetNbinsX()+2)
+    return {"nBins": h.GetNbinsX(), "xmin": h.GetXaxis().GetXmin(), "xmax": h.GetXaxis().GetXmax(), "entries": h.GetEntries(),
+            "contents": [h.GetBinContent(bin) for bin in bins], "errors": [h.GetBinError(bin) for bin in bins]}
+
+# method to get a TH1F from the output of getHistArrays
+def getHistFromArrays(arrays):
+    h = ROOT.TH1F("","",arrays["nBins"],arrays["xmin"],arrays["xmax"])
+    for bin,(content,error) in enumerate(zip(arrays["contents"],arrays["errors"])):
+        h.SetBinContent(bin,content)
+        h.SetBinError(bin,error)
+    h.SetEntries(arrays["entries"])
+    return h
+
+# method to get the style settings of the plots of a module (plotting parameters, colors of the structures and overflow handling), which are part of the hash of each plot
+def getPlotStyle(parameterLists, objects, mergeOverflow):
+    return {"parameters": [[vars(p) for p in parameterList] for parameterList in parameterLists], "objects": objects,
+            "mergeOverflow": inspect.getsource(mergeOverflow), "getHistFromArrays": inspect.getsource(getHistFromArrays)}
+
+# method to get the hash of a plot from its content and style (plot job, style settings and source code of the draw function)
+def getPlotHash(drawFunction, job, style):
+    return hashlib.sha1(inspect.getsource(drawFunction)+json.dumps([job, style], sort_keys=True)).hexdigest()
+
+# method to initialize the worker processes of renderPlots
+def initRenderWorker():
+    gROOT.SetBatch(True)
+
+# method to draw and save one plot in a worker process (takes draw function, plot job, endings to save and hash of the plot)
+def renderPlot(task):
+    drawFunction, job, endings, plotHash = task
+    drawFunction(job, endings)
+    return [os.path.join(job["folder"], job["name"]+ending) for ending in endings], plotHash
+
+# method to draw plots with a process pool in batch mode, each job is a dictionary with at least "name" and "folder" and is drawn with drawFunction(job, endings)
+# the hash of each output is stored in plotHashes.json of the plot directory, outputs which exist with the same hash (same content and style, see getPlotStyle) are not drawn again (unless force)
+def renderPlots(drawFunction, jobs, plotDir, style, endings=[".pdf",".root"], nProcesses=8, force=False):
+    hashFile = os.path.join(plotDir, "plotHashes.json")
+    hashes = {}
+    if os.path.exists(hashFile):
+        with open(hashFile, "r") as f:
+            hashes = json.load(f)
+    tasks = []
+    for job in jobs:
+        plotHash = getPlotHash(drawFunction, job, style)
+        outdated = [ending for ending in endings if force or hashes.get(os.path.relpath(os.path.join(job["folder"], job["name"]+ending), plotDir))!=plotHash
+                    or not os.path.exists(os.path.join(job["folder"], job["name"]+ending))]
+        if outdated:
+            if not os.path.exists(job["folder"]):
+                os.makedirs(job["folder"])
+            tasks.append((drawFunction, job, outdated, plotHash))
+    print "Drawing {} of {} plots ({} up to date)".format(len(tasks), len(jobs), len(jobs)-len(tasks))
+    gROOT.SetBatch(True)
+    if nProcesses>1 and len(tasks)>1:
+        pool = multiprocessing.Pool(min(nProcesses,len(tasks)), initRenderWorker)
+        results = pool.imap_unordered(renderPlot, tasks)
+    else:
+        pool = None
+        results = (renderPlot(task) for task in tasks)
+    try:
+        for fileNames, plotHash in results:
+            for fileName in fileNames:
+                hashes[os.path.relpath(fileName, plotDir)] = plotHash
+    finally:    # hashes of all finished plots are stored, even if drawing of a plot failed
+        if pool:
+            pool.close()
+            pool.join()
+        if not os.path.exists(plotDir):
+            os.makedirs(plotDir)
+        with open(hashFile+".tmp", "w") as f:
+            json.dump(hashes, f, indent=0, sort_keys=True, separators=(",",": "))
+        os.rename(hashFile+".tmp", hashFile)
+
+# method to draw one combined histogram (job from drawCombinedHists) and save it with the given endings
+def drawCombinedHist(job, endings):
+    ih = job["kind"]
+    name = job["name"]
+    objectDict = {}
+    for structure in objects:
+        objectDict[structure[0]] = structure[1]
+    
+    paramDict = {}
+    parameters_temp = parameters
+    if ih==1 : parameters_temp=parameters_e     # get correct parameters
+    elif ih==2 : parameters_temp=parameters_sig
+    for param in parameters_temp:
+        paramDict[param.name] = param
+    gROOT.SetBatch(True)
+    line = ROOT.TLine()
+    line.SetLineStyle(2)
+    line_e = ROOT.TLine()
+    line_e.SetLineStyle(2)
+    line_e.SetLineColor(ROOT.kRed)
+    gStyle.SetFrameLineWidth(2)
+    c = ROOT.TCanvas(randomName(),"",700,600)
+    print name
+    isbpix = name.find("Layer")!=-1
+    structure = name.split("_")[2]      # get structure from name (e.g. Layer1)
+    param = name.split("_")[0]      # get histogram type from name (e.g. movement)
+    hist = mergeOverflow(getHistFromArrays(job["hist"]),True)
+    hist.SetStats(0)
+    hist.SetTitle(";{};{}".format(paramDict[param].label,"Entries"))
+    gPad.SetLeftMargin(100)
+    hist.SetMarkerColor(objectDict[structure])
+    hist.SetLineColor(objectDict[structure])
+    hist.SetLineWidth(2)
+    hist.SetMaximum(1.3*hist.GetMaximum())
+    hist.Draw("hist")
+    hist.GetYaxis().SetTitleOffset(0.95)
+    gStyle.SetHistTopMargin(0.)
+    if ih==0 or ih==2:  # show different thresholds/veto lines depending on the histogram type
+        line.DrawLine(-paramDict[param].cut, 0, -paramDict[param].cut,hist.GetMaximum())
+        line.DrawLine(+paramDict[param].cut, 0, +paramDict[param].cut,hist.GetMaximum())
+    if ih==0 or ih==1:
+        if ih==0: line_e.DrawLine(-paramDict[param].veto, 0, -paramDict[param].veto,hist.GetMaximum())
+        line_e.DrawLine(+paramDict[param].veto, 0, +paramDict[param].veto,hist.GetMaximum())
+    gPad.RedrawAxis()
+    text = ROOT.TLatex()
+    text.SetTextSize(0.04)
+    text.DrawLatexNDC(.1, .91, "#scale[1.2]{#font[61]{CMS}} #font[52]{Private Work}")
+    text.DrawLatexNDC(.6, .91, "2018 pp collisions")
+    text.DrawLatexNDC(.59, .645, structure+name.split("_")[3] if isbpix else structure)
+    if ih!=1:       # show different percentages depending on the histogram type
+        text.DrawLatexNDC(.55, .445, "{:3.0f} % above update threshold".format(100*(hist.Integral(0,hist.GetXaxis().FindBin(-paramDict[param].cut)-1)+hist.Integral(hist.GetXaxis().FindBin(+paramDict[param].cut),hist.GetNbinsX()+1))/hist.GetEntries()))
+    if (ih==0 and paramDict[param].veto<hist.GetXaxis().GetXmax()):
+        text.DrawLatexNDC(.55, .345, "{:3.0f} % above veto threshold".format(100*(hist.Integral(0,hist.GetXaxis().FindBin(-paramDict[param].veto)-1)+hist.Integral(hist.GetXaxis().FindBin(+paramDict[param].veto),hist.GetNbinsX()+1))/hist.GetEntries()))
+    elif (ih==1 and paramDict[param].veto<hist.GetXaxis().GetXmax()):
+        text.DrawLatexNDC(.55, .345, "{:3.0f} % above veto threshold".format(100*hist.Integral(hist.GetXaxis().FindBin(+paramDict[param].veto),hist.GetNbinsX()+1)/hist.GetEntries()))
+    save(name, job["folder"], endings=endings)
+
+# method to draw the combined histograms (in parallel with nProcesses, only plots with changed content or style are drawn again, see renderPlots)
+def drawCombinedHists(hmaps,plotDir,endings=[".pdf",".root"],nProcesses=8,force=False):
+    jobs = []
+    for ih,hmap in enumerate(hmaps):    # ih loops over movement, error and significance hists
+        for name,hist in hmap.iteritems():      # loops over the combination of different detector parts and variables
+            jobs.append({"kind": ih, "name": name, "folder": os.path.join(plotDir, plotFolders[ih]), "hist": getHistArrays(hist)})
+    renderPlots(drawCombinedHist, jobs, plotDir, getPlotStyle([parameters,parameters_e,parameters_sig], objects, mergeOverflow), endings, nProcesses, force)
 
 if __name__ == "__main__":
+    # check that the vectorized combined histograms are identical to the ROOT version on synthetic input (python makeCombinedHists.py --check)
+    if "--check" in sys.argv:
+        sys.exit(0 if checkCombinedHistSynthetic() else 1)
+    
     #########Define the output directory#############
     #  ~plotDir = "./plots/PR_starting_2018B_mid2018D"
     plotDir = "./plots/PR_starting_2018B_diffHits/500Hits"
@@ -311,8 +676,9 @@ if __name__ == "__main__":
     # get input histograms from one DQM file per run
     inputHists = getInputHists(searchPath)
     
-    # prepare combined histograms from multiple runs
-    combinedHists = getCombinedHist(inputHists)
+    # prepare combined histograms from multiple runs (vectorized, checkCombinedHistVectorized(inputHists) compares to the ROOT version getCombinedHist)
+    combinedHists = getCombinedHistVectorized(*stackInputHists(inputHists))
+    #  ~combinedHists = getCombinedHist(inputHists)
     
     # draw combined histograms
     drawCombinedHists(combinedHists,plotDir)
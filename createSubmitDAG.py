@@ -6,29 +6,228 @@ import fileinput
 import urllib
 import json
 import collections
+import errno
+import math
+import hashlib
+import re
+import multiprocessing
+import time
+import threading
+import Queue
+import bisect
+import sqlite3
+from array import array
 
 # define workspace, base directory and output directory (has to be changed for different user)
 workPath="/afs/cern.ch/work/d/dmeuser/alignment/PCL/condor_PCL_2018/run_directories"
 basePath="/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018"
 outputPath="/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/output"
 
+# define CMSSW release used by the jobs (has to be changed for different user)
+cmsswDir="/afs/cern.ch/user/d/dmeuser/alignment/PCL/hgPCL/CMSSW_11_1_0_pre3/src"
+
+# switch to write the runtime environment of the release (output of scramv1 runtime) once to envSnapshot.sh in the base directory, which is sourced by the jobs instead of running scramv1 in each job
+# the snapshot is rewritten if the scram setup of the release (.SCRAM) changed, the jobs fall back to scramv1 if the snapshot is older than the scram setup
+useEnvSnapshot=False
+envSnapshotFile=basePath+"/envSnapshot.sh"
+
+# switch to write the pede config of the study once with cmsDriver.py (pedeStep_ALCA(_HG).py in the log directory of the study), which is rendered by each pede job with its input files and payload and run with cmsRun
+usePedeTemplate=False
+
+# define cache directory for DAS lookups and switch to use it (closed runs do not change, so the cache can be reused across invocations)
+dasCachePath=basePath+"/dasCache"
+useDasCache=True
+
+# counters of cache hits and misses for the DAS lookups
+dasCacheStats={"hit":0,"miss":0}
+
+# switch to retrieve the lumi/file mapping with one DAS query per era (dataset) instead of one query per run
+useEraQuery=False
+
+# era indices already loaded in this invocation in the form of {dataset: LumiFileIndex}
+eraIndices={}
+
+# settings for retrieving the file lists of many runs in parallel (number of parallel das queries, timeout per query in s, number of retries and backoff in s)
+dasMaxParallel=8
+dasTimeout=300
+dasRetries=3
+dasBackoff=10
+
+# settings for writing the mille configs (number of processes used to render the configs of a run and switch to write one manifest per run instead of one config per mille job)
+configProcesses=1
+useConfigManifest=False
+
+# named slots of the mille templates in the form of {slotName: regex matching the placeholder in the template}
+templateSlots=collections.OrderedDict([
+    ("fileList", re.compile(r"'file:milleStep_RECO\.root'")),
+    ("lumiRange", re.compile(r"run:startLumi-run:endLumi")),
+    ("payloadDB", re.compile(r"(?<=sqlite_file:)[^']*payloads(?:_HG)?\.db")),
+    ("thresholdsDB", re.compile(r"(?<=sqlite_file:)[^']*mythresholds[^']*\.db")),
+    ("pedeFileList", re.compile(r"'file:pedeInput\.root'")),
+    ("threads", re.compile(r"(?<=numberOfThreads = cms\.untracked\.uint32\()\d+(?=\))")),
+    ("streams", re.compile(r"(?<=numberOfStreams = cms\.untracked\.uint32\()\d+(?=\))")),
+    ("concurrentLumis", re.compile(r"(?<=numberOfConcurrentLuminosityBlocks = cms\.untracked\.uint32\()\d+(?=\))")),
+    ("wantSummary", re.compile(r"(?<=wantSummary = cms\.untracked\.bool\()\w+(?=\))")),
+])
+
+# settings for multithreaded mille jobs (number of threads, streams (0 uses one stream per thread) and concurrent lumis in cmsRun, memory request in MB is milleMemoryBase+milleMemoryPerThread*threads)
+# with milleThreads=1 configs and submits are the same as for single threaded jobs
+milleThreads=1
+milleStreams=0
+milleConcurrentLumis=1
+milleMemoryBase=1500
+milleMemoryPerThread=500
+
+# switch to use a versioned payload store (one immutable snapshot of the alignment payload per run in payloadStore(_HG) of the output directory, index.json maps each run to its snapshot)
+# each job copies the snapshot of the previous run (payloadParent.txt in output folder of the run) to its local directory instead of opening the shared payloads(_HG).db on eos
+usePayloadStore=False
+
+# switch to write one mille submit per run (one cluster and one dag node per run, jobs are defined by an itemdata table) instead of one submit per mille job
+milleSubmitPerRun=False
+
+# settings for splitting the runs into mille jobs of roughly equal work based on the number of events and bytes per lumi (instead of fixed number of lumis per job)
+# the work of a job is estimated by events/splitEventRate+bytes/splitByteRate in s, jobs of LumisPerJob lumis are split further if they exceed splitTargetWallTime
+adaptiveSplitting=False
+splitTargetWallTime=3600
+splitEventRate=50.
+splitByteRate=5e6
+
+# settings for grouping lumis into mille jobs such that each input file is read by as few jobs as possible (jobs have at most affinityMaxLumisPerJob lumis)
+fileAffinitySplitting=False
+affinityMaxLumisPerJob=10
+
+# switch to run the mille jobs in the condor scratch directory, where the config is written from the manifest of the run and only the mille output is copied to the output folder (no run folders on AFS needed)
+milleScratchMode=False
+
+# switch to only rewrite configs and submits whose inputs changed since the last invocation (hashes are stored in artifacts.json in the log folder of each run)
+incrementalSetup=True
+
+# compiled templates already read in this invocation in the form of {templateName: MilleTemplate}
+templateCache={}
+
 # method to merge two dictionaries (mostly used when adding lowPU runs into nominal range)
 def merge_two_dicts(x, y):
     z = x.copy()   # start with x's keys and values
     z.update(y)    # modifies z with y's keys and values & returns None
     return z
 
-# method to retrieve file list for given run in the form of {lumiNo: "file1, file2"} (currently only defined for 2018BCD)
+# method to retrieve file list for given run in the form of {lumiNo: "file1, file2"} (cached on disk per dataset and run)
 def getFileList_run(run):
+    run=int(run)
+    dataset=getDataset(run)
+    if dataset is None:
+        return {}
+    if useEraQuery:     # take lumi/file mapping from index of complete era
+        return getEraIndex(dataset).getFileDict(run)
+    if useDasCache:     # check if lumi/file mapping was already retrieved in earlier invocation
+        fileDict=readDasCache(dataset,run)
+        if fileDict is not None:
+            dasCacheStats["hit"]+=1
+            return fileDict
+    dasCacheStats["miss"]+=1
+    output=runDasQuery(getDasQuery_run(dataset,run))
+    if output is None:
+        return {}
+    fileDict=parseDasOutput_run(output)
+    if useDasCache and fileDict:    # empty answers are not cached, since they might be caused by DAS problems
+        writeDasCache(dataset,run,fileDict)
+    return fileDict
+
+# method to get the dataset for a given run (currently only defined for 2018BCD), returns None if not defined
+def getDataset(run):
     run=int(run)
     if run<317080 or run>325175:    # check which run era has to be used
-        print "Dataset to run "+run+" not defined"
+        print "Dataset to run "+str(run)+" not defined"
+        return None
     elif run<=319311:
-        output=subprocess.check_output(["dasgoclient -query='lumi,file dataset=/StreamExpress/Run2018B-TkAlMinBias-Express-v1/ALCARECO run={}'".format(run)], shell=True)
+        return "/StreamExpress/Run2018B-TkAlMinBias-Express-v1/ALCARECO"
     elif run<=320393:
-        output=subprocess.check_output(["dasgoclient -query='lumi,file dataset=/StreamExpress/Run2018C-TkAlMinBias-Express-v1/ALCARECO run={}'".format(run)], shell=True)
-    elif run<=325175:
-        output=subprocess.check_output(["dasgoclient -query='lumi,file dataset=/StreamExpress/Run2018D-TkAlMinBias-Express-v1/ALCARECO run={}'".format(run)], shell=True)
+        return "/StreamExpress/Run2018C-TkAlMinBias-Express-v1/ALCARECO"
+    else:
+        return "/StreamExpress/Run2018D-TkAlMinBias-Express-v1/ALCARECO"
+
+# method to get das query of lumi,file for given dataset and run
+def getDasQuery_run(dataset,run):
+    return "lumi,file dataset={} run={}".format(dataset,run)
+
+# method to run a single das query with timeout and retries (waiting dasBackoff*2^attempt between attempts), returns output or None if all attempts failed
+def runDasQuery(query,timeout=None,retries=None,backoff=None):
+    if timeout is None: timeout=dasTimeout
+    if retries is None: retries=dasRetries
+    if backoff is None: backoff=dasBackoff
+    for attempt in range(retries+1):
+        if attempt>0:
+            time.sleep(backoff*2**(attempt-1))
+        proc=subprocess.Popen(["dasgoclient","-query="+query], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timer=threading.Timer(timeout, proc.kill)       # kill query if it takes longer than the timeout
+        timer.start()
+        try:
+            output,error=proc.communicate()
+        finally:
+            timer.cancel()
+        if proc.returncode==0:
+            return output
+        print "DAS query '{}' failed (attempt {} of {}): {}".format(query,attempt+1,retries+1,error.strip() if error else "timeout")
+    return None
+
+# method to retrieve the file lists of several runs with parallel das queries, yields (run, {lumiNo: fileName}) as soon as the query of a run has finished
+# (runs without defined dataset give an empty dictionary, runs with failing das queries give None)
+def fetchFileLists(runs,maxParallel=None):
+    if maxParallel is None: maxParallel=dasMaxParallel
+    tasks=Queue.Queue()
+    results=Queue.Queue()
+    nTasks=0
+    ready=[]    # runs which need no parallel das query in the form of [(run, dataset, cached file list)]
+    for run in runs:
+        dataset=getDataset(run)
+        fileDict=readDasCache(dataset,int(run)) if (dataset and useDasCache and not useEraQuery) else None
+        if dataset is None or useEraQuery or fileDict is not None:
+            ready.append((run,dataset,fileDict))
+        else:
+            dasCacheStats["miss"]+=1
+            tasks.put((run,dataset))
+            nTasks+=1
+    
+    # method run by each worker thread, which takes runs from the task queue until it is empty (a failing query gives None, so the results are always complete)
+    def worker():
+        while True:
+            try:
+                run,dataset=tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                output=runDasQuery(getDasQuery_run(dataset,int(run)))
+            except Exception as exc:    # e.g. dasgoclient not available
+                print "DAS query for run",run,"failed:",exc
+                output=None
+            results.put((run,dataset,output))
+    
+    for i in range(min(maxParallel,nTasks)):    # start das queries before returning the runs which are ready, so they run while these runs are prepared
+        thread=threading.Thread(target=worker)
+        thread.daemon=True
+        thread.start()
+    
+    for run,dataset,fileDict in ready:
+        if dataset is None:
+            yield run,{}
+        elif useEraQuery:   # era index needs only one query per era, so no parallel queries needed
+            yield run,getFileList_run(run)
+        else:
+            dasCacheStats["hit"]+=1
+            yield run,fileDict
+    
+    for i in range(nTasks):     # return results in the order in which the queries finish
+        run,dataset,output=results.get()
+        if output is None:
+            yield run,None
+            continue
+        fileDict=parseDasOutput_run(output)
+        if useDasCache and fileDict:
+            writeDasCache(dataset,int(run),fileDict)
+        yield run,fileDict
+
+# method to parse das output of lumi,file query to {lumiNo: fileName}
+def parseDasOutput_run(output):
     fileDict={}
     for line in output.split("\n"):     #create dictionary to save filenames per lumi (each line corresponds to one file)
         if len(line.split("["))==2 :
@@ -37,16 +236,559 @@ def getFileList_run(run):
             for i in range(len(lumi)):
                 if int(lumi[i])<20: continue    # first 20 lumi section should not be used for study
                 fileDict[int(lumi[i])]=fileName
-    with open("./testDict.pkl","wb") as f:      # write dictionary to pkl               
-        pickle.dump(fileDict, f, pickle.HIGHEST_PROTOCOL)
     return fileDict
+
+# class storing the lumi/file mapping of a complete era in arrays sorted by run and lumi, the file names are stored once in a file table
+class LumiFileIndex:
+    def __init__(self):
+        self.runs = array("i")      # run number per entry
+        self.lumis = array("i")     # lumi number per entry
+        self.fileIds = array("i")   # position of file in file table per entry
+        self.files = []             # file table
     
-# method to create the log folder, returns path to log folder
-def createLogFolder(run,lumi,HG_bool):
+    # method to fill the index from (fileName, run, [lumiNo]) entries (e.g. streamed from das output)
+    def fill(self, entries):
+        fileIdDict = {}
+        runs = array("i")
+        lumis = array("i")
+        fileIds = array("i")
+        for fileName,run,lumiList in entries:
+            if fileName not in fileIdDict:
+                fileIdDict[fileName] = len(self.files)
+                self.files.append(fileName)
+            for lumi in lumiList:
+                runs.append(run)
+                lumis.append(lumi)
+                fileIds.append(fileIdDict[fileName])
+        order = sorted(xrange(len(runs)), key=lambda i: (runs[i],lumis[i]))     # sort entries by run and lumi to allow binary search
+        self.runs = array("i", (runs[i] for i in order))
+        self.lumis = array("i", (lumis[i] for i in order))
+        self.fileIds = array("i", (fileIds[i] for i in order))
+        return self
+    
+    # method to get {lumiNo: fileName} for a given run
+    def getFileDict(self, run, minLumi=20):     # first 20 lumi section should not be used for study
+        first = bisect.bisect_left(self.runs, run)
+        last = bisect.bisect_right(self.runs, run)
+        return dict((self.lumis[i],self.files[self.fileIds[i]]) for i in xrange(first,last) if self.lumis[i]>=minLumi)
+    
+    # method to get the runs stored in the index
+    def getRuns(self):
+        return sorted(set(self.runs))
+    
+    # method to write the index to a pkl file (arrays are stored as raw strings to keep the file compact)
+    def save(self, fileName):
+        with open(fileName+".tmp","wb") as f:
+            pickle.dump((self.runs.tostring(),self.lumis.tostring(),self.fileIds.tostring(),self.files), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(fileName+".tmp",fileName)
+    
+    # method to read the index from a pkl file written by save
+    def load(self, fileName):
+        with open(fileName,"rb") as f:
+            runs,lumis,fileIds,self.files = pickle.load(f)
+        self.runs = array("i")
+        self.runs.fromstring(runs)
+        self.lumis = array("i")
+        self.lumis.fromstring(lumis)
+        self.fileIds = array("i")
+        self.fileIds.fromstring(fileIds)
+        return self
+
+# method to parse das output of file,run,lumi query line by line, yields (fileName, run, [lumiNo])
+def parseDasOutput_era(lines):
+    for line in lines:
+        parts = line.split(None,2)      # each line looks like "fileName run [lumi1,lumi2,...]"
+        if len(parts)!=3: continue
+        lumis = parts[2].strip().strip("[]").split(",")
+        yield parts[0],int(parts[1]),[int(lumi) for lumi in lumis if lumi.strip()]
+
+# method to retrieve the index of a complete era with a single das query (stored in the DAS cache folder of the era)
+def getEraIndex(dataset):
+    if dataset in eraIndices:
+        dasCacheStats["hit"]+=1
+        return eraIndices[dataset]
+    indexFile=getDasCacheFolder(dataset)+"/eraIndex.pkl"
+    if useDasCache and os.path.exists(indexFile):
+        dasCacheStats["hit"]+=1
+        eraIndices[dataset]=LumiFileIndex().load(indexFile)
+        return eraIndices[dataset]
+    dasCacheStats["miss"]+=1
+    print "Querying DAS for complete dataset",dataset
+    query="dasgoclient -query='file,run,lumi dataset={}'".format(dataset)
+    proc=subprocess.Popen([query], shell=True, stdout=subprocess.PIPE)
+    index=LumiFileIndex().fill(parseDasOutput_era(iter(proc.stdout.readline, "")))      # stream das output into index
+    if proc.wait()!=0:
+        raise subprocess.CalledProcessError(proc.returncode, query)
+    if useDasCache:
+        createCacheFolder(dataset)
+        index.save(indexFile)
+    eraIndices[dataset]=index
+    return index
+
+# method to get the DAS cache folder of a given dataset (one folder per era), returns path to folder
+def getDasCacheFolder(dataset):
+    return dasCachePath+"/"+dataset.strip("/").replace("/","__")
+
+# method to create the DAS cache folder of a given dataset, returns path to folder
+def createCacheFolder(dataset):
+    dirname=getDasCacheFolder(dataset)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as exc: # Guard against race condition
+            if exc.errno != errno.EEXIST:
+                raise
+    return dirname
+
+# method to read the cached {lumiNo: fileName} for a given dataset and run, returns None if not cached (kind is added to the file name for other cached information of the run)
+def readDasCache(dataset,run,kind=""):
+    cacheFile=getDasCacheFolder(dataset)+"/run"+str(run)+kind+".pkl"
+    if not os.path.exists(cacheFile):
+        return None
+    try:
+        with open(cacheFile,"rb") as f:
+            return pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):     # broken cache file, DAS has to be queried again
+        return None
+
+# method to write {lumiNo: fileName} for a given dataset and run to the DAS cache (kind is added to the file name for other cached information of the run)
+def writeDasCache(dataset,run,fileDict,kind=""):
+    cacheFile=createCacheFolder(dataset)+"/run"+str(run)+kind+".pkl"
+    with open(cacheFile+".tmp","wb") as f:      # write to temporary file first to avoid broken cache files
+        pickle.dump(fileDict, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(cacheFile+".tmp",cacheFile)
+
+# method to invalidate the DAS cache for a single run, for a complete era (dataset) or everything (the era index is only removed together with the era)
+def invalidateDasCache(run=None,dataset=None):
+    if run is not None:
+        if dataset is None:
+            dataset=getDataset(run)
+            if dataset is None: return
+        for kind in ["","_weights","_sizes"]:
+            cacheFile=getDasCacheFolder(dataset)+"/run"+str(run)+kind+".pkl"
+            if os.path.exists(cacheFile):
+                os.remove(cacheFile)
+    elif dataset is not None:
+        eraIndices.pop(dataset,None)
+        if os.path.exists(getDasCacheFolder(dataset)):
+            shutil.rmtree(getDasCacheFolder(dataset))
+    else:
+        eraIndices.clear()
+        if os.path.exists(dasCachePath):
+            shutil.rmtree(dasCachePath)
+
+# method to print how many DAS queries were saved by the cache
+def printDasCacheStats():
+    print "DAS cache: {} hits (DAS queries saved), {} misses".format(dasCacheStats["hit"],dasCacheStats["miss"])
+    
+# method to parse das output of file size query to {fileName: bytes}
+def parseDasOutput_sizes(output_size):
+    fileSizes={}
+    for line in output_size.split("\n"):   # each line looks like "fileName size"
+        parts=line.split()
+        if len(parts)==2:
+            fileSizes[parts[0]]=float(parts[1])
+    return fileSizes
+
+# method to retrieve size of each file of a given run in the form of {fileName: bytes} (cached on disk like the file list), returns None if DAS query fails
+def getFileSizes_run(run):
+    run=int(run)
+    dataset=getDataset(run)
+    if dataset is None:
+        return None
+    if useDasCache:
+        fileSizes=readDasCache(dataset,run,"_sizes")
+        if fileSizes is not None:
+            dasCacheStats["hit"]+=1
+            return fileSizes
+    dasCacheStats["miss"]+=1
+    output_size=runDasQuery("file dataset={} run={} | grep file.name,file.size".format(dataset,run))
+    if output_size is None:
+        return None
+    fileSizes=parseDasOutput_sizes(output_size)
+    if useDasCache and fileSizes:
+        writeDasCache(dataset,run,fileSizes,"_sizes")
+    return fileSizes
+
+# method to parse das output of file,lumi,events query to {lumiNo: (events, bytes)} (size of each file is shared by its lumis according to the number of events)
+def parseDasOutput_weights(output,fileSizes):
+    lumiWeights={}
+    for line in output.split("\n"):     # each line looks like "fileName [lumi1,lumi2,...] [events1,events2,...]"
+        lists=re.findall("\[([^\]]*)\]",line)
+        if len(lists)!=2: continue
+        fileName=line.split()[0]
+        lumis=[int(lumi) for lumi in lists[0].split(",") if lumi.strip()]
+        events=[int(nEvents) if nEvents.strip().isdigit() else 0 for nEvents in lists[1].split(",")]
+        if len(events)!=len(lumis): events=[0]*len(lumis)    # events per lumi not available
+        totalEvents=sum(events)
+        for lumi,nEvents in zip(lumis,events):
+            fraction=float(nEvents)/totalEvents if totalEvents>0 else 1./len(lumis)
+            lumiWeights[lumi]=(lumiWeights.get(lumi,(0,0))[0]+nEvents,lumiWeights.get(lumi,(0,0))[1]+fraction*fileSizes.get(fileName,0))
+    return lumiWeights
+
+# method to retrieve number of events and bytes per lumi for a given run in the form of {lumiNo: (events, bytes)} (cached on disk like the file list), returns None if DAS query fails
+def getLumiWeights_run(run):
+    run=int(run)
+    dataset=getDataset(run)
+    if dataset is None:
+        return None
+    if useDasCache:
+        lumiWeights=readDasCache(dataset,run,"_weights")
+        if lumiWeights is not None:
+            dasCacheStats["hit"]+=1
+            return lumiWeights
+    dasCacheStats["miss"]+=1
+    output=runDasQuery("file,lumi,events dataset={} run={}".format(dataset,run))
+    fileSizes=getFileSizes_run(run)
+    if output is None or fileSizes is None:
+        return None
+    lumiWeights=parseDasOutput_weights(output,fileSizes)
+    if useDasCache and lumiWeights:
+        writeDasCache(dataset,run,lumiWeights,"_weights")
+    return lumiWeights
+
+# method to split the lumis [startLumi, startLumi+lumisMax) into consecutive jobs, returns [(startLumi, number of lumis)]
+# the lumis are split into the fixed windows of lumisPerJob lumis first, windows whose work exceeds targetWallTime are split further into jobs of roughly equal work
+# (the boundaries are set where the cumulated work of the window crosses multiples of the average work per job)
+def splitRunAdaptive(lumiWeights,startLumi,lumisMax,lumisPerJob,targetWallTime=None,eventRate=None,byteRate=None):
+    if targetWallTime is None: targetWallTime=splitTargetWallTime
+    if eventRate is None: eventRate=splitEventRate
+    if byteRate is None: byteRate=splitByteRate
+    jobs=[]
+    for windowStart in range(startLumi,startLumi+lumisMax,lumisPerJob):
+        lumis=range(windowStart,min(windowStart+lumisPerJob,startLumi+lumisMax))
+        cumWork=[]      # work summed up to (including) each lumi of the window
+        total=0.
+        for lumi in lumis:
+            events,nBytes=lumiWeights.get(lumi,(0,0))
+            total+=events/eventRate+nBytes/byteRate
+            cumWork.append(total)
+        nJobs=max(1,min(len(lumis),int(math.ceil(total/targetWallTime))))
+        boundaries=[0]
+        for k in range(1,nJobs):        # first lumi of each job
+            boundary=bisect.bisect_left(cumWork,k*total/nJobs)+1
+            if boundaries[-1]<boundary<len(lumis): boundaries.append(boundary)
+        boundaries.append(len(lumis))
+        jobs.extend((lumis[first],last-first) for first,last in zip(boundaries[:-1],boundaries[1:]))
+    return jobs
+
+# method to get the number of bytes read by given jobs [(startLumi, number of lumis)], each job reads every file containing one of its lumis (files without size count as 1 byte)
+def getBytesRead(jobs,fileDict,fileSizes):
+    total=0.
+    for lumi,nLumis in jobs:
+        files=set(fileDict[i] for i in range(lumi,lumi+nLumis) if i in fileDict)
+        total+=sum(fileSizes.get(fileName,1.) for fileName in files)
+    return total
+
+# method to group the lumis [startLumi, startLumi+lumisMax) into consecutive jobs with at most maxLumisPerJob lumis such that the total number of bytes read by all jobs is minimal
+# (dynamic programming over the lumi/file graph, for the same number of bytes more jobs without empty jobs are preferred), returns [(startLumi, number of lumis)]
+def planFileAffinityJobs(fileDict,startLumi,lumisMax,maxLumisPerJob,fileSizes):
+    lumis=range(startLumi,startLumi+lumisMax)
+    best=[(0.,0,0)]+[None]*len(lumis)       # best (bytes, empty jobs, -jobs) for the first i lumis
+    previous=[0]*(len(lumis)+1)     # start of last job in best grouping of the first i lumis
+    for i in range(1,len(lumis)+1):
+        files=set()
+        nBytes=0.
+        for j in range(i-1,max(i-maxLumisPerJob,0)-1,-1):   # last job covers lumis[j:i]
+            fileName=fileDict.get(lumis[j])
+            if fileName is not None and fileName not in files:
+                files.add(fileName)
+                nBytes+=fileSizes.get(fileName,1.)
+            candidate=(best[j][0]+nBytes,best[j][1]+(0 if files else 1),best[j][2]-1)
+            if best[i] is None or candidate<best[i]:
+                best[i]=candidate
+                previous[i]=j
+    jobs=[]
+    i=len(lumis)
+    while i>0:
+        jobs.append((lumis[previous[i]],i-previous[i]))
+        i=previous[i]
+    return jobs[::-1]
+
+# method to print how much read amplification (bytes read by all jobs / bytes of all files used) is removed by the file-affinity jobs compared to the fixed windows
+def printReadAmplification(run,fileDict,fileSizes,fixedJobs,affinityJobs):
+    usedFiles=set(fileDict[i] for lumi,nLumis in fixedJobs for i in range(lumi,lumi+nLumis) if i in fileDict)
+    uniqueBytes=sum(fileSizes.get(fileName,1.) for fileName in usedFiles)
+    if uniqueBytes==0: return
+    fixedBytes=getBytesRead(fixedJobs,fileDict,fileSizes)
+    affinityBytes=getBytesRead(affinityJobs,fileDict,fileSizes)
+    print "Run {}: read amplification {:.2f} with {} fixed jobs, {:.2f} with {} file-affinity jobs ({:.1f} GB less read)".format(
+        run,fixedBytes/uniqueBytes,len(fixedJobs),affinityBytes/uniqueBytes,len(affinityJobs),(fixedBytes-affinityBytes)/1e9)
+
+# method to write the start lumis of the expected mille jobs of a run to the output folder of the run (one lumi per line)
+def writeExpectedJobs(run,HG_bool,lumis):
+    dirname=getRunOutputFolder(run,HG_bool)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError as exc: # Guard against race condition
+            if exc.errno != errno.EEXIST:
+                raise
+    with open(dirname+"/expectedJobs.txt.tmp","w") as f:
+        f.write("".join(str(lumi)+"\n" for lumi in lumis))
+    os.rename(dirname+"/expectedJobs.txt.tmp",dirname+"/expectedJobs.txt")
+
+# method to get checksum of a file in the same format as written by milleStep.sh (output of cksum)
+def getChecksum(fileName):
+    return subprocess.check_output(["cksum",fileName]).split()[0]
+
+# method to check the completion records (completed/lumi_N.json written by milleStep.sh) of all expected mille jobs in an output folder and write AlcaFiles.txt with the complete mille outputs
+# outputs with missing or corrupt record, missing file or mismatching size or checksum are excluded, returns 0 if at least one complete output was found (used as exit code in pedeStep.sh)
+def writeAlcaFileList(dirname,verifyChecksum=True):
+    with open(dirname+"/expectedJobs.txt","r") as f:
+        lumis=[int(line) for line in f if line.strip()]
+    files=[]
+    excluded=[]
+    for lumi in lumis:
+        recordFile=dirname+"/completed/lumi_"+str(lumi)+".json"
+        if not os.path.exists(recordFile):
+            excluded.append((lumi,"no completion record"))
+            continue
+        try:
+            with open(recordFile,"r") as f:
+                record=json.load(f)
+            fileName=dirname+"/"+record["file"]
+            size,checksum=record["size"],record["checksum"]
+        except (ValueError,KeyError):     # truncated or corrupt record (e.g. killed stage-out)
+            excluded.append((lumi,"corrupt completion record"))
+            continue
+        if not os.path.exists(fileName):
+            excluded.append((lumi,"output missing"))
+        elif os.path.getsize(fileName)!=size:
+            excluded.append((lumi,"size mismatch"))
+        elif verifyChecksum and getChecksum(fileName)!=checksum:
+            excluded.append((lumi,"checksum mismatch"))
+        else:
+            files.append(record["file"])
+    for lumi,reason in excluded:
+        print "Excluding mille job of lumi",lumi,"("+reason+")"
+    print "Using",len(files),"of",len(lumis),"mille outputs"
+    with open(dirname+"/AlcaFiles.txt","w") as f:
+        f.write("".join("file:"+fileName+"\n" for fileName in files))
+    return 0 if files else 1
+
+# method to get the folder of the payload store
+def getPayloadStoreFolder(HG_bool):
+    if HG_bool:
+        return outputPath+"/payloadStore_HG"
+    else:
+        return outputPath+"/payloadStore"
+
+# method to get the starting payload of a study (db file in the output directory, which is also the shared payload if the payload store is not used)
+def getStartPayload(HG_bool):
+    return outputPath+("/payloads_HG.db" if HG_bool else "/payloads.db")
+
+# method to read the index of the payload store in the form of {run: snapshot file} (the starting payload is stored as run "initial")
+def readPayloadIndex(HG_bool):
+    indexFile=getPayloadStoreFolder(HG_bool)+"/index.json"
+    if not os.path.exists(indexFile):
+        return {}
+    with open(indexFile,"r") as f:
+        return json.load(f)
+
+# method to write the index of the payload store (written to a temporary file first, so jobs never read an incomplete index)
+def savePayloadIndex(HG_bool,index):
+    indexFile=getPayloadStoreFolder(HG_bool)+"/index.json"
+    with open(indexFile+".tmp","w") as f:
+        json.dump(index,f,indent=1,sort_keys=True)
+    os.rename(indexFile+".tmp",indexFile)
+
+# method to set the snapshot of a run in the index of the payload store
+def writePayloadIndex(HG_bool,run,snapshot):
+    index=readPayloadIndex(HG_bool)
+    index[str(run)]=snapshot
+    savePayloadIndex(HG_bool,index)
+
+# method to remove runs which are rescheduled from the index of the payload store (jobs must not pick up the snapshot of a previous attempt), snapshot files are kept
+def removePayloadIndex(HG_bool,runs):
+    index=readPayloadIndex(HG_bool)
+    removed=[run for run in runs if index.pop(str(run),None) is not None]
+    if removed:
+        savePayloadIndex(HG_bool,index)
+
+# method to get the name of the snapshot of a payload db file in the payload store (named by run and checksum)
+def getSnapshotName(run,dbFile):
+    return "run"+str(run)+"_"+getChecksum(dbFile)+".db"
+
+# method to store a payload db file as snapshot of a run, snapshots are never overwritten (a rerun of the pede job only changes the index)
+def publishPayloadSnapshot(HG_bool,run,dbFile):
+    dirname=getPayloadStoreFolder(HG_bool)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    snapshot=getSnapshotName(run,dbFile)
+    if not os.path.exists(dirname+"/"+snapshot):
+        shutil.copyfile(dbFile,dirname+"/"+snapshot+".tmp")
+        os.rename(dirname+"/"+snapshot+".tmp",dirname+"/"+snapshot)
+    writePayloadIndex(HG_bool,run,snapshot)
+    print "Published payload of run",run,"as",snapshot
+    return 0
+
+# method to publish the payload after the pede step of a run (used in pedeStep.sh), if no new payload was produced the run uses the snapshot of the previous run
+def publishRunPayload(HG_bool,run,dbFile,updated):
+    if updated:
+        return publishPayloadSnapshot(HG_bool,run,dbFile)
+    parent=readPayloadParents(getRunOutputFolder(run,HG_bool))[0]
+    snapshot=readPayloadIndex(HG_bool).get(parent)
+    if snapshot is None:
+        print "No payload snapshot for run",parent
+        return 1
+    writePayloadIndex(HG_bool,run,snapshot)
+    return 0
+
+# method to check if a db file written by the pede step contains a payload of the given tag (used in pedeStep.sh to tell a pede step without update apart from a failed import)
+# returns 0 if the tag has an IOV, 99 if the file, the IOV table or the IOV is missing (pede step without new payload), other errors are raised
+def hasPayload(dbFile,tag="SiPixelAli_pcl"):
+    if not os.path.exists(dbFile):
+        return 99
+    connection=sqlite3.connect(dbFile)
+    try:
+        nIOVs=connection.execute("SELECT COUNT(*) FROM IOV WHERE TAG_NAME=?",(tag,)).fetchone()[0]
+    except sqlite3.OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        nIOVs=0
+    finally:
+        connection.close()
+    return 0 if nIOVs>0 else 99
+
+# method to read the runs whose payloads can be used as input of a run (nearest first) from the output folder of the run
+def readPayloadParents(dirname):
+    with open(dirname+"/payloadParent.txt","r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+# method to copy the input payload of a run to a local file (used in milleStep.sh and pedeStep.sh), returns 0 if a snapshot was found
+# the snapshot of the previous run is used if available, otherwise the one of the second to last run (mille jobs of the speculative dag start before the previous pede job finished)
+def fetchPayloadSnapshot(HG_bool,dirname,dbFile):
+    index=readPayloadIndex(HG_bool)
+    for parent in readPayloadParents(dirname):
+        if parent in index:
+            shutil.copyfile(getPayloadStoreFolder(HG_bool)+"/"+index[parent],dbFile+".tmp")
+            os.rename(dbFile+".tmp",dbFile)
+            print "Using payload of run",parent,"("+index[parent]+")"
+            return 0
+    print "No payload snapshot found for",dirname
+    return 1
+
+# method to write the input payload runs of all prepared runs (payloadParent.txt in output folder of each run) based on the order of the runs
+# the first run starts from startRun, which is "initial" (payloads(_HG).db of the output directory, stored in the payload store if not yet done or if the file changed) or any run already in the store to restart a study from this run
+def writePayloadParents(runRecords,HG_bool,startRun="initial"):
+    index=readPayloadIndex(HG_bool)
+    if startRun=="initial":
+        dbFile=getStartPayload(HG_bool)
+        if index.get("initial")!=getSnapshotName("initial",dbFile):     # not stored yet or starting payload was replaced
+            if "initial" in index:      # payloads of the runs were derived from the old starting payload, so the runs have to be rerun
+                print "Starting payload",dbFile,"changed, storing new snapshot"
+                removePayloadIndex(HG_bool,[runRecord["run"] for runRecord in runRecords])
+            publishPayloadSnapshot(HG_bool,"initial",dbFile)
+    elif str(startRun) not in index:
+        raise ValueError("No payload snapshot for run "+str(startRun))
+    parents=[str(startRun)]
+    for runRecord in sorted(runRecords, key=lambda record: int(record["run"])):
+        with open(runRecord["outputFolder"]+"/payloadParent.txt","w") as f:
+            f.write("".join(parent+"\n" for parent in parents[:2]))
+        parents.insert(0,str(runRecord["run"]))
+
+# method to prepare a sweep running the same mille job with different numbers of threads (one folder per thread count in basePath/sweeps), returns path to dag file of the sweep
+# each point runs in its own slot with request_cpus equal to the number of threads, the results are written by sweepStep.sh and can be shown with printThreadSweep
+def writeThreadSweep(run,HG_bool,lumi,LumisPerJob,threadCounts,fileDict=None):
+    if fileDict is None:
+        fileDict=getFileList_run(run)
+    fileList=getFileList_job(LumiIntervalIndex(fileDict),lumi,LumisPerJob)
+    sweepDir=basePath+"/sweeps/"+("HG_" if HG_bool else "")+"run"+str(run)+"_lumi_"+str(lumi)
+    dag=Dag()
+    for threads in threadCounts:
+        dirname=sweepDir+"/threads_"+str(threads)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        values=getMilleSlots(run,lumi,LumisPerJob,fileList,payloadDB=getStartPayload(HG_bool) if usePayloadStore else None,threads=threads)     # sweepStep.sh does not fetch a snapshot of the payload store
+        values["threads"]=str(threads)      # also set for single threaded point
+        values["wantSummary"]="True"        # number of processed events is taken from summary
+        with open(dirname+"/milleStep.py","w") as f:
+            f.write(getMilleTemplate(HG_bool).render(values))
+        with open(dirname+"/submit_sweep.sub","w") as f:
+            f.write("""
+Universe   = vanilla
+Executable = {0}/sweepStep.sh
+Arguments  = {1} {2}
+Log        = {1}/log_sweep.log
+Output     = {1}/out_sweep.out
+Error      = {1}/error_sweep.error
+x509userproxy = $ENV(X509_USER_PROXY)
+request_cpus = {2}
+request_memory = {3}
++JobFlavour = "microcentury"
++AccountingGroup = "group_u_CMS.CAF.ALCA"
+Queue
+""".format(basePath,dirname,threads,milleMemoryBase+milleMemoryPerThread*threads))
+        dag.addNode("sweep_threads_"+str(threads),dirname+"/submit_sweep.sub")
+    return dag.write(sweepDir+"/dag_sweep.dag")
+
+# method to print processed events per second (and per core) for each point of a thread sweep
+def printThreadSweep(sweepDir):
+    results=[]
+    for dirname in os.listdir(sweepDir):
+        if dirname.startswith("threads_") and os.path.exists(sweepDir+"/"+dirname+"/result.json"):
+            with open(sweepDir+"/"+dirname+"/result.json","r") as f:
+                results.append(json.load(f))
+    print "{:>8} {:>10} {:>10} {:>10} {:>15}".format("threads","events","wallTime","events/s","events/s/core")
+    for result in sorted(results, key=lambda result: result["threads"]):
+        rate=float(result["events"])/result["wallTime"] if result["wallTime"]>0 else 0
+        print "{:>8} {:>10} {:>10} {:>10.1f} {:>15.1f}".format(result["threads"],result["events"],result["wallTime"],rate,rate/result["threads"])
+
+# method to check if the environment snapshot is missing or older than any file of the scram setup of the release (same check as in milleStep.sh and pedeStep.sh)
+def isEnvSnapshotStale(fileName=None):
+    if fileName is None: fileName=envSnapshotFile
+    if not os.path.exists(fileName):
+        return True
+    snapshotTime=os.path.getmtime(fileName)
+    for dirpath,dirnames,filenames in os.walk(cmsswDir+"/../.SCRAM"):
+        for name in dirnames+filenames:
+            if os.path.getmtime(os.path.join(dirpath,name))>snapshotTime:
+                return True
+    return False
+
+# method to write the runtime environment of the release to a file which can be sourced by the jobs (written in the environment of the submitting user, so paths have to be available on the condor nodes)
+def writeEnvSnapshot(fileName=None):
+    if fileName is None: fileName=envSnapshotFile
+    environment=subprocess.check_output("scramv1 runtime -sh",shell=True,cwd=cmsswDir)
+    with open(fileName+".tmp","w") as f:
+        f.write("# runtime environment of "+os.path.normpath(cmsswDir+"/..")+" written by createSubmitDAG.py\n")
+        f.write(environment)
+    os.rename(fileName+".tmp",fileName)
+    print "Written environment snapshot",fileName
+
+# method to write the environment snapshot if needed (or remove it if snapshots are not used, since the jobs use any existing snapshot)
+def prepareEnvSnapshot():
+    if useEnvSnapshot:
+        if isEnvSnapshotStale():
+            writeEnvSnapshot()
+    elif os.path.exists(envSnapshotFile):
+        os.remove(envSnapshotFile)
+
+# method to measure the time needed to set up the environment with scramv1 and with the snapshot (average over nTimes in a new shell each), returns (scramv1 time, snapshot time) in s
+# the time measured in the jobs is part of the job telemetry (stages setup and setupSnapshot)
+def measureEnvSetup(nTimes=3):
+    if isEnvSnapshotStale():
+        writeEnvSnapshot()
+    times=[]
+    for command in ("cd "+cmsswDir+" && eval `scramv1 runtime -sh`","source "+envSnapshotFile):
+        start=time.time()
+        for i in range(nTimes):
+            subprocess.check_call(["bash","-c",command+" > /dev/null"])
+        times.append((time.time()-start)/nTimes)
+    print "Environment setup per job: {:.2f} s with scramv1, {:.2f} s with snapshot ({:.2f} s saved)".format(times[0],times[1],times[0]-times[1])
+    return tuple(times)
+
+# method to get the log folder of a complete run
+def getRunLogFolder(run,HG_bool):
     if HG_bool:
-        dirname=basePath+"/logs/HG_run"+str(run)+"/lumi_"+str(lumi)
+        return basePath+"/logs/HG_run"+str(run)
     else :
-        dirname=basePath+"/logs_LG/run"+str(run)+"/lumi_"+str(lumi)
+        return basePath+"/logs_LG/run"+str(run)
+
+# method to create the log folder, returns path to log folder
+def createLogFolder(run,lumi,HG_bool):
+    dirname=getRunLogFolder(run,HG_bool)+"/lumi_"+str(lumi)
         
     if not os.path.exists(dirname):
         try:
@@ -56,12 +798,16 @@ def createLogFolder(run,lumi,HG_bool):
                 raise
     return dirname
 
-# method to create the run folder, returns path to run folder
-def createRunFolder(run,lumi,HG_bool):
+# method to get the run folder of a mille job
+def getRunFolder(run,lumi,HG_bool):
     if HG_bool:
-        dirname=workPath+"/HG_run"+str(run)+"/lumi_"+str(lumi)
+        return workPath+"/HG_run"+str(run)+"/lumi_"+str(lumi)
     else :
-        dirname=workPath+"/run"+str(run)+"/lumi_"+str(lumi)
+        return workPath+"/run"+str(run)+"/lumi_"+str(lumi)
+
+# method to create the run folder, returns path to run folder
+def createRunFolder(run,lumi,HG_bool):
+    dirname=getRunFolder(run,lumi,HG_bool)
         
     if not os.path.exists(dirname):
         try:
@@ -71,12 +817,16 @@ def createRunFolder(run,lumi,HG_bool):
                 raise
     return dirname
 
-# method to clean output folder (useful in case job are failing)
-def cleanOutputFolder(run,HG_bool,complete):
+# method to get the output folder of a complete run
+def getRunOutputFolder(run,HG_bool):
     if HG_bool:
-        dirname=outputPath+"/HG_run"+str(run)
+        return outputPath+"/HG_run"+str(run)
     else :
-        dirname=outputPath+"/run"+str(run)
+        return outputPath+"/run"+str(run)
+
+# method to clean output folder (useful in case job are failing)
+def cleanOutputFolder(run,HG_bool,complete):
+    dirname=getRunOutputFolder(run,HG_bool)
     if os.path.exists(dirname):
         if complete:
             shutil.rmtree(dirname)
@@ -87,54 +837,260 @@ def cleanOutputFolder(run,HG_bool,complete):
                 os.remove(dirname+"/treeFile.root")
             
 
-# method which return file list for a given starting lumi and given lumis per job
-def getFileList_job(fileDict,lumi,LumisPerJob):
-    fileList=""
-    for i in range(0,LumisPerJob):      # loop over number of lumis per job
-        if lumi+i in fileDict.keys():   # current lumi given bei start lumi + loop lumi
-            if fileDict[lumi+i] not in fileList:    # only add file if not already in list
-                fileList+="'"+fileDict[lumi+i]+"',\n"
-    return fileList
+# class storing the lumi/file mapping of a single run as sorted intervals of consecutive lumis read from the same file (built once per run)
+class LumiIntervalIndex:
+    def __init__(self, fileDict):
+        self.starts = []    # first lumi of interval
+        self.ends = []      # last lumi of interval
+        self.files = []     # file of interval
+        for lumi in sorted(fileDict):
+            if self.files and lumi==self.ends[-1]+1 and fileDict[lumi]==self.files[-1]:    # extend interval if lumi continues last interval
+                self.ends[-1] = lumi
+            else:
+                self.starts.append(lumi)
+                self.ends.append(lumi)
+                self.files.append(fileDict[lumi])
+    
+    # method which returns ordered file list (without duplicates) and the covered lumi ranges [(firstLumi,lastLumi)] for the lumis in [startLumi, startLumi+LumisPerJob)
+    def query(self, startLumi, LumisPerJob):
+        stopLumi = startLumi+LumisPerJob-1
+        files = []
+        lumiRanges = []
+        i = max(bisect.bisect_right(self.starts, startLumi)-1, 0)     # last interval starting before or at startLumi
+        while i<len(self.starts) and self.starts[i]<=stopLumi:
+            if self.ends[i]>=startLumi:
+                if self.files[i] not in files:
+                    files.append(self.files[i])
+                first = max(self.starts[i],startLumi)
+                last = min(self.ends[i],stopLumi)
+                if lumiRanges and lumiRanges[-1][1]+1==first:   # merge consecutive intervals of different files
+                    lumiRanges[-1] = (lumiRanges[-1][0],last)
+                else:
+                    lumiRanges.append((first,last))
+            i += 1
+        return files,lumiRanges
+
+# method which return file list for a given starting lumi and given lumis per job (taken from the LumiIntervalIndex of the run)
+def getFileList_job(lumiIndex,lumi,LumisPerJob):
+    files,lumiRanges=lumiIndex.query(lumi,LumisPerJob)
+    return "".join("'"+fileName+"',\n" for fileName in files)
     
-# method which write mille config starting from template and replacing file list and start/stop lumi
-def writeMilleConfig(run,HG_bool,lumi,LumisPerJob,fileList,dirRun):
+# class storing a template split into literal text and named slots, so that rendering only needs to join strings
+class MilleTemplate:
+    def __init__(self, text):
+        matches = []
+        for name,regex in templateSlots.iteritems():
+            for m in regex.finditer(text):
+                matches.append((m.start(),m.end(),name))
+        matches.sort()
+        self.chunks = []        # literal text between the slots
+        self.slots = []         # slot names in the order of appearance
+        self.defaults = {}      # text in the template at the slot position (used if slot value is not given)
+        self.hash = hashlib.sha1(text).hexdigest()      # used to check if configs have to be rewritten
+        pos = 0
+        for start,end,name in matches:
+            self.chunks.append(text[pos:start])
+            self.slots.append(name)
+            self.defaults.setdefault(name,text[start:end])
+            pos = end
+        self.chunks.append(text[pos:])
+    
+    # method to render the template with given {slotName: value}
+    def render(self, values):
+        out = [self.chunks[0]]
+        for slot,chunk in zip(self.slots,self.chunks[1:]):
+            out.append(values.get(slot,self.defaults[slot]))
+            out.append(chunk)
+        return "".join(out)
+
+# method to get name of mille template
+def getMilleTemplateName(HG_bool):
     if HG_bool:
-        fileName="milleStep_ALCA_HG.py"
+        return "milleStep_ALCA_HG.py"
     else:
-        fileName="milleStep_ALCA.py"
-    
-    f = open(basePath+"/templates/"+fileName,'r')
-    filedata = f.read()
-    f.close()
+        return "milleStep_ALCA.py"
+
+# method to get compiled mille template (template file is only read once per invocation)
+def getMilleTemplate(HG_bool):
+    fileName=getMilleTemplateName(HG_bool)
+    if fileName not in templateCache:
+        with open(basePath+"/templates/"+fileName,'r') as f:
+            templateCache[fileName]=MilleTemplate(f.read())
+    return templateCache[fileName]
+
+# method to get the slot values of a mille config (payload and thresholds db are only replaced if given)
+def getMilleSlots(run,lumi,LumisPerJob,fileList,payloadDB=None,thresholdsDB=None,threads=None):
+    if threads is None: threads=milleThreads
+    values={
+        "fileList": fileList,       # set file list
+        "lumiRange": str(run)+":"+str(lumi)+"-"+str(run)+":"+str(lumi+LumisPerJob-1),      # set start and stop lumi
+        }
+    if payloadDB is None and usePayloadStore: payloadDB="payloads.db"     # snapshot copied to local directory by milleStep.sh
+    if payloadDB: values["payloadDB"]=payloadDB
+    if thresholdsDB: values["thresholdsDB"]=thresholdsDB
+    if threads>1:       # multithreaded running
+        values["threads"]=str(threads)
+        values["streams"]=str(milleStreams)
+        values["concurrentLumis"]=str(milleConcurrentLumis)
+    return values
+
+# method to render and write a single config (used by process pool in writeMilleConfigs), takes (HG_bool, slot values, output file)
+def writeConfigJob(job):
+    HG_bool,values,outFile=job
+    with open(outFile,'w') as f:
+        f.write(getMilleTemplate(HG_bool).render(values))
 
-    newdata = filedata.replace("'file:milleStep_RECO.root'",fileList)       # set file list
-    newdata = newdata.replace("run:startLumi-run:endLumi",str(run)+":"+str(lumi)+"-"+str(run)+":"+str(lumi+LumisPerJob-1))      # set start and stop lumi
+# method to write the mille configs of all jobs of a run in one go, jobs are given as [(lumi, LumisPerJob, fileList, dirRun)]
+# if manifestFile is given, only the slot values of all jobs are written to this file instead of one config per job
+def writeMilleConfigs(run,HG_bool,jobs,nProcesses=1,manifestFile=None):
+    if manifestFile:
+        manifest={"template": getMilleTemplateName(HG_bool), "jobs": {}}
+        for lumi,LumisPerJob,fileList,dirRun in jobs:
+            manifest["jobs"][str(lumi)]=getMilleSlots(run,lumi,LumisPerJob,fileList)
+        with open(manifestFile+".tmp","w") as f:
+            json.dump(manifest,f)
+        os.rename(manifestFile+".tmp",manifestFile)
+        return
+    configJobs=[(HG_bool,getMilleSlots(run,lumi,LumisPerJob,fileList),dirRun+"/"+getMilleTemplateName(HG_bool)) for lumi,LumisPerJob,fileList,dirRun in jobs]
+    if nProcesses>1 and len(configJobs)>1:
+        getMilleTemplate(HG_bool)       # compile template before forking, so each process does not read it again
+        pool=multiprocessing.Pool(min(nProcesses,len(configJobs)))
+        pool.map(writeConfigJob,configJobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in configJobs:
+            writeConfigJob(job)
 
-    f = open(dirRun+"/"+fileName,'w')   # write config to run directory
-    f.write(newdata)
-    f.close()
+# method to write the config of a single mille job from the manifest of the run (used in milleStep.sh)
+def writeConfigFromManifest(manifestFile,lumi,outFile):
+    with open(manifestFile,"r") as f:
+        manifest=json.load(f)
+    with open(basePath+"/templates/"+manifest["template"],'r') as f:
+        template=MilleTemplate(f.read())
+    with open(outFile,'w') as f:
+        f.write(template.render(manifest["jobs"][str(lumi)]))
     
+# method to get the pede template of a study (next to the log folders of the runs)
+def getPedeTemplateFile(HG_bool):
+    if HG_bool:
+        return os.path.dirname(getRunLogFolder(0,HG_bool))+"/pedeStep_ALCA_HG.py"
+    else:
+        return os.path.dirname(getRunLogFolder(0,HG_bool))+"/pedeStep_ALCA.py"
+
+# method to get the cmsDriver.py command of the pede step (same as in pedeStep.sh, but with placeholder input file, which is replaced by the pedeFileList slot)
+def getPedeDriverCommand(HG_bool,fileName):
+    if HG_bool:
+        modifiers=["--procModifiers","high_granularity_pcl"]
+        thresholdsDB=cmsswDir+"/CondFormats/PCLConfig/test/mythresholds_test.db"
+        payloadDB=outputPath+"/payloads_HG.db"
+    else:
+        modifiers=[]
+        thresholdsDB=cmsswDir+"/CondFormats/PCLConfig/test/mythresholds.db"
+        payloadDB=outputPath+"/payloads.db"
+    return ["cmsDriver.py","pedeStep","--data","--conditions","106X_dataRun3_Express_v2","--scenario","pp","--era","Run2_2018","-s","ALCAHARVEST:SiPixelAli",
+            "--filein","file:pedeInput.root"]+modifiers+["--customise_commands",
+            "process.GlobalTag.toGet = cms.VPSet(cms.PSet(record = cms.string('AlignPCLThresholdsRcd'),tag = cms.string('PCLThresholds_express_v0'),connect = cms.string('sqlite_file:"+thresholdsDB+"')),"
+            "cms.PSet(record = cms.string('TrackerAlignmentRcd'),tag = cms.string('SiPixelAli_pcl'),connect = cms.string('sqlite_file:"+payloadDB+"')))",
+            "--no_exec","--python_filename",fileName]
+
+# method to write the pede template of a study with cmsDriver.py (only if the command changed), the hash of the command is stored in the first line of the template
+def writePedeTemplate(HG_bool):
+    fileName=getPedeTemplateFile(HG_bool)
+    command=getPedeDriverCommand(HG_bool,fileName+".tmp")
+    header="# pede template written by createSubmitDAG.py with cmsDriver.py (command hash "+getInputHash(command[:-1])+")\n"
+    if os.path.exists(fileName):
+        with open(fileName,"r") as f:
+            if f.readline()==header:
+                return fileName
+    if not os.path.exists(os.path.dirname(fileName)):
+        os.makedirs(os.path.dirname(fileName))
+    subprocess.check_call(command)
+    with open(fileName+".tmp","r") as f:
+        config=f.read()
+    if not templateSlots["pedeFileList"].search(config):
+        raise ValueError("Input file placeholder not found in pede config written by cmsDriver.py")
+    with open(fileName+".tmp","w") as f:
+        f.write(header+config)
+    os.rename(fileName+".tmp",fileName)
+    print "Written pede template",fileName
+    return fileName
+
+# method to write (or remove) the pede template of a study, pedeStep.sh uses cmsDriver.py if there is no template
+def preparePedeTemplate(HG_bool):
+    if usePedeTemplate:
+        writePedeTemplate(HG_bool)
+    elif os.path.exists(getPedeTemplateFile(HG_bool)):
+        os.remove(getPedeTemplateFile(HG_bool))
+
+# method to write the pede config of a run from the template with the input files (list of "file:..." as written to AlcaFiles.txt) and the payload db (used in pedeStep.sh)
+def writePedeConfig(templateFile,fileListFile,payloadDB,outFile):
+    with open(templateFile,"r") as f:
+        template=MilleTemplate(f.read())
+    with open(fileListFile,"r") as f:
+        fileList="".join("'"+line.strip()+"',\n" for line in f if line.strip())
+    with open(outFile,"w") as f:
+        f.write(template.render({"pedeFileList": fileList, "payloadDB": payloadDB}))
+
+# method to get cpu and memory request of a mille job for the condor submit (empty for single threaded jobs)
+def getResourceRequest(threads=None):
+    if threads is None: threads=milleThreads
+    if threads<=1:
+        return ""
+    return "request_cpus = {}\nrequest_memory = {}\n".format(threads,milleMemoryBase+milleMemoryPerThread*threads)
+
 # method to write condor submit script for mille job log folder(needs argument used for milleStep.sh)
 def writeMilleSubmit(run,HG_bool,lumi,fileList,dirname):
     with open(dirname+"/submit_mille.sub","w") as f:
-        f.write("""
+        f.write(getMilleSubmit(run,HG_bool,lumi,dirname))
+    return dirname+"/submit_mille.sub"
+
+# method to get content of condor submit script for mille job
+def getMilleSubmit(run,HG_bool,lumi,dirname):
+    return """
 Universe   = vanilla
 Executable = milleStep.sh
-Arguments  = {0} {1} {3}
+Arguments  = {0} {1} {3}{4}
 Log        = {2}/log_mille.log
 Output     = {2}/out_mille.out
 Error      = {2}/error_mille.error
 x509userproxy = $ENV(X509_USER_PROXY)
-+JobFlavour = "microcentury"
+{5}+JobFlavour = "microcentury"
 +AccountingGroup = "group_u_CMS.CAF.ALCA"
 Queue
-""".format(run,HG_bool,dirname,lumi))
+""".format(run,HG_bool,dirname,lumi," scratch" if milleScratchMode else "",getResourceRequest())
+
+# method to write one condor submit script for all mille jobs of a run to the log folder of the run (jobs are given by their start lumi)
+def writeMilleSubmit_run(run,HG_bool,lumis,dirname):
+    with open(dirname+"/submit_mille.sub","w") as f:
+        f.write(getMilleSubmit_run(run,HG_bool,lumis,dirname))
     return dirname+"/submit_mille.sub"
 
+# method to get content of condor submit script for all mille jobs of a run (one job per line of the itemdata table)
+def getMilleSubmit_run(run,HG_bool,lumis,dirname):
+    return """
+Universe   = vanilla
+Executable = milleStep.sh
+Arguments  = $(RunNo) $(HG_bool) $(Start_Lumi){4}
+Log        = {2}/log_mille.log
+Output     = {2}/lumi_$(Start_Lumi)/out_mille.out
+Error      = {2}/lumi_$(Start_Lumi)/error_mille.error
+x509userproxy = $ENV(X509_USER_PROXY)
+{5}+JobFlavour = "microcentury"
++AccountingGroup = "group_u_CMS.CAF.ALCA"
+Queue RunNo,HG_bool,Start_Lumi from (
+{3})
+""".format(run,HG_bool,dirname,"".join("{} {} {}\n".format(run,HG_bool,lumi) for lumi in lumis)," scratch" if milleScratchMode else "",getResourceRequest())
+
 # method to write condor submit script for pede job to log folder(needs argument used for pedeStep.sh)
 def writePedeSubmit(run,HG_bool,dirname):
     with open(dirname+"/submit_pede.sub","w") as f:
-        f.write("""
+        f.write(getPedeSubmit(run,HG_bool,dirname))
+    return dirname+"/submit_pede.sub"
+
+# method to get content of condor submit script for pede job
+def getPedeSubmit(run,HG_bool,dirname):
+    return """
 Universe   = vanilla
 Executable = pedeStep.sh
 Arguments  = {0} {1}
@@ -144,149 +1100,492 @@ Error      = {2}/error_pede.error
 +JobFlavour = "microcentury"
 +AccountingGroup = "group_u_CMS.CAF.ALCA"
 Queue
-""".format(run,HG_bool,dirname))
-    return dirname+"/submit_pede.sub"
+""".format(run,HG_bool,dirname)
+
+# method to get hash of the inputs of a generated file (inputs have to be json serializable)
+def getInputHash(*inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
 
-# method to write dag submit for single run
-def writeDag(dirname):
-    dirList=os.listdir(dirname)
-    dag=""
-    for dir in dirList:
-        if "lumi" in dir:
-            dag+="JOB mille_"+dir+" "+dirname+"/"+dir+"/submit_mille.sub\n"     # declare mille jobs
-    dag+= "JOB pedeStep "+dirname+"/submit_pede.sub\n"      # declare pede job
-    dag+="PARENT"
-    for dir in dirList:
-        if "lumi" in dir:
-            dag+=" mille_"+dir
-    dag+=" CHILD pedeStep"      # set pede job as child of mille jobs
+# method to read the hashes of the files generated for a run in the last invocation in the form of {fileName: inputHash}
+def readArtifactManifest(dirname):
+    if not os.path.exists(dirname+"/artifacts.json"):
+        return {}
+    with open(dirname+"/artifacts.json","r") as f:
+        return json.load(f)
+
+# method to write the hashes of the files generated for a run
+def writeArtifactManifest(dirname,artifacts):
+    with open(dirname+"/artifacts.json.tmp","w") as f:
+        json.dump(artifacts,f,sort_keys=True,indent=0)
+    os.rename(dirname+"/artifacts.json.tmp",dirname+"/artifacts.json")
+
+# method to get the hashes of the configs from the hashes of all generated files (submits do not change the output of a run)
+def getConfigArtifacts(artifacts):
+    return dict((fileName,inputHash) for fileName,inputHash in artifacts.iteritems() if not fileName.endswith(".sub"))
+
+# method to check if a generated file has to be (re)written, i.e. its input hash changed or it is missing (if checkExists is set), the new hash is stored in newArtifacts
+def isStale(fileName,inputHash,artifacts,newArtifacts,checkExists=True):
+    newArtifacts[fileName]=inputHash
+    if artifacts.get(fileName)!=inputHash:
+        return True
+    return checkExists and not os.path.exists(fileName)
+
+# class describing a dagman job (nodes, edges, variables and categories), which is validated and written line by line to a dag file
+class Dag:
+    def __init__(self):
+        self.nodes = collections.OrderedDict()      # {nodeName: submitFile}
+        self.splices = collections.OrderedDict()    # {spliceName: dagFile}
+        self.edges = []                             # [([parentNames],[childNames])]
+        self.vars = collections.OrderedDict()       # {nodeName: {varName: value}}
+        self.categories = collections.OrderedDict() # {nodeName: category}
+        self.maxJobs = collections.OrderedDict()    # {category: maximal number of running jobs}
+        self.scripts = collections.OrderedDict()    # {nodeName: [(PRE or POST, command)]}
+        self.preSkip = collections.OrderedDict()    # {nodeName: exit code of PRE script for which the node is skipped}
+    
+    # method to add a node with optional category and variables (available as $(varName) in the submit file)
+    def addNode(self, name, submitFile, category=None, **variables):
+        self.nodes[name] = submitFile
+        if category:
+            self.categories[name] = category
+        if variables:
+            self.vars[name] = collections.OrderedDict(sorted(variables.items()))
+    
+    # method to add a PRE or POST script to a node (with skipCode the node is marked as done without running the job if the PRE script exits with this code)
+    def addScript(self, name, scriptType, command, skipCode=None):
+        self.scripts.setdefault(name,[]).append((scriptType,command))
+        if skipCode is not None:
+            self.preSkip[name] = skipCode
     
-    with open(dirname+"/dag_submit.dag","w") as f:
-        f.write(dag)
+    # method to add a splice, i.e. a complete dag included as one node
+    def addSplice(self, name, dagFile):
+        self.splices[name] = dagFile
+    
+    # method to add edges from all parents to all children (single names or lists of names)
+    def addEdge(self, parents, children):
+        if isinstance(parents, basestring): parents = [parents]
+        if isinstance(children, basestring): children = [children]
+        if parents and children:    # edges without parents or children are ignored (e.g. run without remaining mille jobs in resume dag)
+            self.edges.append((list(parents),list(children)))
+    
+    # method to check that all edges, variables and categories refer to declared nodes and that the graph has no cycles
+    def validate(self):
+        names = set(self.nodes)|set(self.splices)
+        for parents,children in self.edges:
+            for name in parents+children:
+                if name not in names:
+                    raise ValueError("Edge refers to undeclared node "+name)
+        for name in self.vars.keys()+self.categories.keys()+self.scripts.keys():
+            if name not in self.nodes:
+                raise ValueError("Variables, category or script set for undeclared node "+name)
+        childDict = collections.defaultdict(set)
+        nParents = dict((name,0) for name in names)
+        for parents,children in self.edges:
+            for parent in parents:
+                for child in children:
+                    if child not in childDict[parent]:
+                        childDict[parent].add(child)
+                        nParents[child] += 1
+        ready = [name for name in names if nParents[name]==0]       # topological sort, nodes left at the end are part of a cycle
+        nSorted = 0
+        while ready:
+            name = ready.pop()
+            nSorted += 1
+            for child in childDict[name]:
+                nParents[child] -= 1
+                if nParents[child]==0: ready.append(child)
+        if nSorted!=len(names):
+            raise ValueError("Dag contains a cycle involving "+", ".join(sorted(name for name in names if nParents[name]>0)))
+    
+    # method to validate and write the dag to a given file
+    def write(self, fileName):
+        self.validate()
+        with open(fileName+".tmp","w") as f:
+            for name,submitFile in self.nodes.iteritems():
+                f.write("JOB {} {}\n".format(name,submitFile))
+            for name,dagFile in self.splices.iteritems():
+                f.write("SPLICE {} {}\n".format(name,dagFile))
+            for name,variables in self.vars.iteritems():
+                f.write("VARS {} {}\n".format(name," ".join('{}="{}"'.format(key,value) for key,value in variables.iteritems())))
+            for name,category in self.categories.iteritems():
+                f.write("CATEGORY {} {}\n".format(name,category))
+            for category,maxJobs in self.maxJobs.iteritems():
+                f.write("MAXJOBS {} {}\n".format(category,maxJobs))
+            for name,scripts in self.scripts.iteritems():
+                for scriptType,command in scripts:
+                    f.write("SCRIPT {} {} {}\n".format(scriptType,name,command))
+            for name,skipCode in self.preSkip.iteritems():
+                f.write("PRE_SKIP {} {}\n".format(name,skipCode))
+            for parents,children in self.edges:
+                f.write("PARENT {} CHILD {}\n".format(" ".join(parents)," ".join(children)))
+        os.rename(fileName+".tmp",fileName)
+        return fileName
+
+# method to get the description of a prepared run from its log folder (used if submitRun was not called in this invocation)
+def getRunRecord(dirname):
+    dirname=dirname.rstrip("/")
+    lumis=sorted(int(dir_lumi.split("_")[1]) for dir_lumi in os.listdir(dirname) if dir_lumi.startswith("lumi_"))
+    runName=os.path.basename(dirname)
+    run=int(re.match(".*run(\d+)",runName).group(1))
+    HG_bool=runName.startswith("HG_")
+    return {"run": run, "HG": HG_bool, "logFolder": dirname, "outputFolder": getRunOutputFolder(run,HG_bool), "lumis": lumis,
+            "milleSubmitPerRun": os.path.exists(dirname+"/submit_mille.sub"), "configManifest": os.path.exists(dirname+"/milleConfigs.json")}
+
+# method to add the mille and pede jobs of a run to a dag (with withRunName the log folder name of the run is part of the node names), returns names of mille nodes and pede node
+def addRunToDag(dag,runRecord,withRunName=False):
+    runName="_"+os.path.basename(runRecord["logFolder"]) if withRunName else ""
+    milleNodes=[]
+    if runRecord.get("milleSubmitPerRun"):     # all mille jobs of the run are one node
+        if runRecord["lumis"]:      # no mille node if all mille jobs are already done (resume dag)
+            milleNodes.append("mille"+runName)
+            dag.addNode(milleNodes[-1],runRecord["logFolder"]+"/submit_mille.sub",category="mille")
+    else:
+        for lumi in runRecord["lumis"]:
+            milleNodes.append("mille"+runName+"_lumi_"+str(lumi))
+            dag.addNode(milleNodes[-1],runRecord["logFolder"]+"/lumi_"+str(lumi)+"/submit_mille.sub",category="mille")
+    pedeNode="pedeStep"+runName
+    dag.addNode(pedeNode,runRecord["logFolder"]+"/submit_pede.sub",category="pede")
+    dag.addEdge(milleNodes,pedeNode)      # set pede job as child of mille jobs
+    return milleNodes,pedeNode
+
+# method to build dag for several runs running iteratively (mille jobs of each run wait for the pede job of the previous run)
+# with splice=True each run is written to its own dag file in the log folder of the run and included as splice
+# with speculative=True the mille jobs of each run already start after the pede job of the second to last run, using the payload available at that time,
+# they are rerun after the pede job of the previous run only if this pede job imported a new payload (checked by checkPayloadUpdate.sh)
+def buildDag_Trend(runRecords,splice=False,speculative=False):
+    if speculative and splice:
+        raise ValueError("Speculative trend dag can not be written with splices")
+    dag=Dag()
+    before=None     # pede job (or splice) of previous run
+    beforeBefore=None   # pede job of second to last run (used for speculative dag)
+    beforeRecord=None
+    for runRecord in sorted(runRecords, key=lambda record: int(record["run"])):
+        runName=os.path.basename(runRecord["logFolder"])
+        if splice:
+            runDag=Dag()
+            addRunToDag(runDag,runRecord)
+            dag.addSplice(runName,runDag.write(runRecord["logFolder"]+"/run.dag"))
+            if before: dag.addEdge(before,runName)
+            before=runName
+        elif speculative:
+            if not runRecord.get("configManifest"):     # config in run folder is removed after the first mille job
+                raise ValueError("Speculative trend dag needs configs from manifest (useConfigManifest=True) for run "+str(runRecord["run"]))
+            milleNodes,pedeNode=addRunToDag(dag,runRecord,True)
+            if beforeBefore: dag.addEdge(beforeBefore,milleNodes)
+            if before:      # rerun of mille jobs, which is skipped if previous pede job did not change the payload
+                remilleNodes=[]
+                for milleNode in milleNodes:
+                    remilleNodes.append("re"+milleNode)
+                    dag.addNode(remilleNodes[-1],dag.nodes[milleNode],category="mille")
+                    dag.addScript(remilleNodes[-1],"PRE",basePath+"/checkPayloadUpdate.sh "+beforeRecord["outputFolder"],skipCode=99)
+                dag.addEdge([before]+milleNodes,remilleNodes)
+                dag.addEdge(remilleNodes,pedeNode)
+            beforeBefore=before
+            before=pedeNode
+            beforeRecord=runRecord
+        else:
+            milleNodes,pedeNode=addRunToDag(dag,runRecord,True)
+            if before: dag.addEdge(before,milleNodes or pedeNode)       # if runs is not first run, the corresponding jobs have to wait for the previous run to finish
+            before=pedeNode
+    return dag
+
+# method to write dag submit for single run (takes record returned by submitRun or reads the log folder)
+def writeDag(dirname,runRecord=None):
+    if runRecord is None:
+        runRecord=getRunRecord(dirname)
+    restoreMilleConfigs([runRecord])
+    dag=Dag()
+    addRunToDag(dag,runRecord)
+    dag.write(dirname+"/dag_submit.dag")
     return "dag_submit.dag"
 
 # method to write dag submit for several runs (running iteratively) Takes log folder as input, which has submits for mille and pede inside
-def writeDag_Trend(dirname):
-    dirList=sorted(os.listdir(dirname))
-    dag=""
-    firstRun=True       # check if run is first run of submit
-    pedeStep_before=""
-    for dir_run in dirList:
-        if "run" not in dir_run: continue
-        for dir_lumi in os.listdir(dirname+"/"+dir_run):
-            if "lumi" in dir_lumi:
-                dag+="JOB mille_"+dir_run+"_"+dir_lumi+" "+dirname+"/"+dir_run+"/"+dir_lumi+"/submit_mille.sub\n"
-        dag+= "JOB pedeStep_"+dir_run+" "+dirname+"/"+dir_run+"/submit_pede.sub\n"
-        if firstRun==False:     # if runs is not first run, the corresponding jobs have to wait for the previous run to finish
-            dag+=pedeStep_before
-            for dir_lumi in os.listdir(dirname+"/"+dir_run):
-                if "lumi" in dir_lumi:
-                    dag+=" mille_"+dir_run+"_"+dir_lumi
-        dag+="\nPARENT"
-        for dir_lumi in os.listdir(dirname+"/"+dir_run):
-            if "lumi" in dir_lumi:
-                dag+=" mille_"+dir_run+"_"+dir_lumi
-        dag+=" CHILD pedeStep_"+dir_run+"\n\n"
-        pedeStep_before="PARENT pedeStep_"+dir_run+" CHILD"
-        firstRun=False
-    
-    with open(dirname+"/dag_submit.dag","w") as f:
-        f.write(dag)
+# the runs can be given as records returned by submitRun, otherwise all runs in the log folder are used
+# with skipComplete the complete runs at the beginning of the trend (see planResume) are not part of the dag, so a new invocation for unchanged runs does not rerun them, returns None if all runs are complete
+def writeDag_Trend(dirname,runRecords=None,splice=False,speculative=False,skipComplete=True):
+    if runRecords is None:
+        runRecords=[getRunRecord(dirname+"/"+dir_run) for dir_run in os.listdir(dirname) if "run" in dir_run and os.path.isdir(dirname+"/"+dir_run)]
+    if skipComplete:
+        runRecords=planResume(runRecords)
+        if not runRecords:
+            return None
+    restoreMilleConfigs(runRecords)     # raises before anything is invalidated if configs are missing and can not be written
+    if skipComplete:
+        invalidateResumedJobs(runRecords)
+    buildDag_Trend(runRecords,splice,speculative).write(dirname+"/dag_submit.dag")
     return "dag_submit.dag"
-    
 
+# method to write the missing mille configs of the jobs of runs which are part of a dag (milleStep.sh removes the run folder after each job, so runs prepared before have no configs left)
+# the configs can only be written for runs prepared by submitRun in this invocation (the record contains the file lists of the jobs), otherwise the configs have to be taken from the manifest (useConfigManifest=True)
+def restoreMilleConfigs(runRecords):
+    for runRecord in runRecords:
+        if runRecord.get("configManifest"):     # config is written by milleStep.sh
+            continue
+        configName=getMilleTemplateName(runRecord["HG"])
+        missing=set(lumi for lumi in runRecord["lumis"] if not os.path.exists(getRunFolder(runRecord["run"],lumi,runRecord["HG"])+"/"+configName))
+        if not missing:
+            continue
+        if "jobs" not in runRecord:
+            raise ValueError("Configs of {} mille jobs of run {} are missing (removed after the jobs), prepare the run with submitRun or use configs from manifest (useConfigManifest=True)".format(len(missing),runRecord["run"]))
+        jobs=[job for job in runRecord["jobs"] if job[0] in missing]
+        for job in jobs:
+            createRunFolder(runRecord["run"],job[0],runRecord["HG"])
+        writeMilleConfigs(runRecord["run"],runRecord["HG"],jobs,configProcesses)
+        print "Restored",len(jobs),"mille configs of run",runRecord["run"]
+
+# method to get the time the pede job of a run finished successfully and stored the payload of the run (markers written by pedeStep.sh), None if the run has no payload
+# with the payload store the run has to be in the index of the store, otherwise the new payload has to be imported (payloadUpdated) or the pede step has to be finished without new payload (payloadUnchanged)
+def getPayloadImportTime(runRecord):
+    fileName=runRecord["outputFolder"]+"/pedeCompleted"
+    if not os.path.exists(fileName):
+        return None
+    if os.path.exists(runRecord["outputFolder"]+"/payloadParent.txt"):     # payload store is used
+        snapshot=readPayloadIndex(runRecord["HG"]).get(str(runRecord["run"]))
+        if snapshot is None or not os.path.exists(getPayloadStoreFolder(runRecord["HG"])+"/"+snapshot):
+            return None
+    elif not os.path.exists(runRecord["outputFolder"]+"/payloadUpdated") and not os.path.exists(runRecord["outputFolder"]+"/payloadUnchanged"):
+        return None
+    return os.path.getmtime(fileName)
 
-def submitRun(run,HG_bool,LumisMax,LumisPerJob,StartLumi,SingleRun=True):
+# method to get the start lumis of the mille jobs of a run with a completion record written after a given time (mille jobs before have used an older payload) and an output with the recorded size
+def getCompletedMilleJobs(runRecord,since=0):
+    completed=set()
+    for lumi in runRecord["lumis"]:
+        recordFile=runRecord["outputFolder"]+"/completed/lumi_"+str(lumi)+".json"
+        if not os.path.exists(recordFile) or os.path.getmtime(recordFile)<since:
+            continue
+        try:
+            with open(recordFile,"r") as f:
+                record=json.load(f)
+            fileName=runRecord["outputFolder"]+"/"+record["file"]
+            size=record["size"]
+        except (ValueError,KeyError):     # truncated or corrupt record, the mille job is rerun
+            continue
+        if os.path.exists(fileName) and os.path.getsize(fileName)==size:
+            completed.add(lumi)
+    return completed
+
+# method to find the work left in a trend of runs, returns records of all runs starting with the first run without stored payload (see getPayloadImportTime, with "lumis" reduced to the mille jobs which have to be rerun)
+# runs before are complete and their payloads are reused, the complete mille jobs of the first incomplete run are reused if they ran after the pede job of the previous run, all later runs are rerun completely
+def planResume(runRecords):
+    plan=[]
+    previousTime=0      # completion time of pede job of previous run
+    for runRecord in sorted(runRecords, key=lambda record: int(record["run"])):
+        if not plan:
+            pedeTime=getPayloadImportTime(runRecord)
+            if pedeTime is not None and pedeTime>=previousTime:
+                previousTime=pedeTime
+                continue
+            completed=getCompletedMilleJobs(runRecord,previousTime)
+            print "Resuming at run",runRecord["run"],"("+str(len(completed)),"of",len(runRecord["lumis"]),"mille jobs reused)"
+        else:
+            completed=set()
+        pending=[lumi for lumi in runRecord["lumis"] if lumi not in completed]
+        if runRecord.get("milleSubmitPerRun") and pending:      # mille jobs of the run can only be submitted together
+            pending=runRecord["lumis"]
+        resumeRecord=dict(runRecord)
+        resumeRecord["lumis"]=pending
+        plan.append(resumeRecord)
+    print len(runRecords)-len(plan),"of",len(runRecords),"runs complete"
+    return plan
+
+# method to remove the completion records, pede markers and payload store entries of the jobs which are rerun, so the pede step, the mille jobs and the next resume plan never use outputs of a previous attempt (outputs themselves are kept)
+def invalidateResumedJobs(plan):
+    for runRecord in plan:
+        for lumi in runRecord["lumis"]:
+            recordFile=runRecord["outputFolder"]+"/completed/lumi_"+str(lumi)+".json"
+            if os.path.exists(recordFile):
+                os.remove(recordFile)
+        for fileName in ("pedeCompleted","payloadUpdated","payloadUnchanged"):
+            if os.path.exists(runRecord["outputFolder"]+"/"+fileName):
+                os.remove(runRecord["outputFolder"]+"/"+fileName)
+        removePayloadIndex(runRecord["HG"],[runRecord["run"]])
+
+# method to write a dag with only the unfinished work of a trend (dag_resume.dag in the log folder), which can be used instead of rerunning the complete trend after a failure
+# the runs can be given as records returned by submitRun, otherwise all runs in the log folder are used, returns None if all runs are complete
+# configs of the pending mille jobs removed by milleStep.sh are written again for records of submitRun, for runs read from the log folder the configs have to be taken from the manifest (useConfigManifest=True)
+def writeDag_Resume(dirname,runRecords=None,splice=False):
+    if runRecords is None:
+        runRecords=[getRunRecord(dirname+"/"+dir_run) for dir_run in os.listdir(dirname) if "run" in dir_run and os.path.isdir(dirname+"/"+dir_run)]
+    plan=planResume(runRecords)
+    if not plan:
+        return None
+    restoreMilleConfigs(plan)       # raises before anything is invalidated if configs are missing and can not be written
+    invalidateResumedJobs(plan)
+    buildDag_Trend(plan,splice).write(dirname+"/dag_resume.dag")
+    return "dag_resume.dag"
+
+# method to prepare all configs and submits of a run, returns description of the run used to build the dag ({"run","HG","logFolder","lumis","jobs"}) or None if run is not used
+def submitRun(run,HG_bool,LumisMax,LumisPerJob,StartLumi,SingleRun=True,fileDict=None):
     print "Submitting run",run
-    fileDict=getFileList_run(run)
+    if fileDict is None:    # file list can be given if it was already retrieved (e.g. by fetchFileLists)
+        fileDict=getFileList_run(run)
     if len(fileDict)>100:       # use only runs with at least 100 lumi sections
         
         LumisMax=min(max(fileDict.keys()),LumisMax)     # set maximal number of lumis to set value or maximum available lumis
         
-        cleanOutputFolder(run,HG_bool,True)     # clean output folder in case some run before fails
+        lumiIndex=LumiIntervalIndex(fileDict)      # index used to find the files of each mille job
+        
+        dirname_totalRun=getRunLogFolder(run,HG_bool)
+        artifacts=readArtifactManifest(dirname_totalRun) if incrementalSetup else {}   # hashes of files written in last invocation
+        newArtifacts={}
+        templateHash=getMilleTemplate(HG_bool).hash
         
-        for lumi in range(StartLumi,LumisMax+StartLumi,LumisPerJob):    # create run and log folder for each mille job and write config and submit
+        windows=[(lumi,LumisPerJob) for lumi in range(StartLumi,LumisMax+StartLumi,LumisPerJob)]    # fixed number of lumis per mille job
+        if adaptiveSplitting:       # mille jobs with roughly equal number of events and bytes
+            lumiWeights=getLumiWeights_run(run)
+            if lumiWeights:
+                windows=splitRunAdaptive(lumiWeights,StartLumi,LumisMax,LumisPerJob)
+            else:
+                print "No events per lumi available for run",run,"(using",LumisPerJob,"lumis per job)"
+        elif fileAffinitySplitting:     # mille jobs reading each input file as few times as possible
+            fileSizes=getFileSizes_run(run) or {}
+            affinityWindows=planFileAffinityJobs(fileDict,StartLumi,LumisMax,affinityMaxLumisPerJob,fileSizes)
+            printReadAmplification(run,fileDict,fileSizes,windows,affinityWindows)
+            windows=affinityWindows
+        
+        jobs=[]
+        for lumi,nLumis in windows:    # create log folder for each mille job and write submit (only if inputs changed)
             dirname_log=createLogFolder(run,lumi,HG_bool)
-            dirname_run=createRunFolder(run,lumi,HG_bool)
-            fileList=getFileList_job(fileDict,lumi,LumisPerJob)
+            dirname_run=getRunFolder(run,lumi,HG_bool)
+            fileList=getFileList_job(lumiIndex,lumi,nLumis)
+            jobs.append((lumi,nLumis,fileList,dirname_run))
             
-            writeMilleConfig(run,HG_bool,lumi,LumisPerJob,fileList,dirname_run)
+            # configs in the run folder are removed by milleStep.sh after the job, so only changed inputs are checked
+            if not useConfigManifest:
+                isStale(dirname_run+"/"+getMilleTemplateName(HG_bool),getInputHash(templateHash,getMilleSlots(run,lumi,nLumis,fileList)),artifacts,newArtifacts,False)
             
-            writeMilleSubmit(run,HG_bool,lumi,fileList,dirname_log)
-    
-        dirname_totalRun=os.path.dirname(dirname_log)
-        writePedeSubmit(run,HG_bool,dirname_totalRun)       # write pede submit (not config needed since cmsDriver.py is used in pedeStep.sh)
+            if not milleSubmitPerRun and isStale(dirname_log+"/submit_mille.sub",getInputHash(getMilleSubmit(run,HG_bool,lumi,dirname_log)),artifacts,newArtifacts):
+                writeMilleSubmit(run,HG_bool,lumi,fileList,dirname_log)
+        
+        lumis=[job[0] for job in jobs]
+        if milleSubmitPerRun and isStale(dirname_totalRun+"/submit_mille.sub",getInputHash(getMilleSubmit_run(run,HG_bool,lumis,dirname_totalRun)),artifacts,newArtifacts):
+            writeMilleSubmit_run(run,HG_bool,lumis,dirname_totalRun)       # write one submit for all mille jobs of the run
+        
+        if isStale(dirname_totalRun+"/submit_pede.sub",getInputHash(getPedeSubmit(run,HG_bool,dirname_totalRun)),artifacts,newArtifacts):
+            writePedeSubmit(run,HG_bool,dirname_totalRun)       # write pede submit (not config needed since cmsDriver.py is used in pedeStep.sh)
+        
+        manifestFile=dirname_totalRun+"/milleConfigs.json" if useConfigManifest else None     # manifest contains configs of all mille jobs
+        manifestStale=useConfigManifest and isStale(manifestFile,getInputHash(templateHash,[getMilleSlots(run,*job[:3]) for job in jobs]),artifacts,newArtifacts)
+        
+        if getConfigArtifacts(artifacts)!=getConfigArtifacts(newArtifacts):     # only touch run and output folders of runs whose configs changed
+            cleanOutputFolder(run,HG_bool,True)     # clean output folder in case some run before fails
+            removePayloadIndex(HG_bool,[run])       # snapshot of the previous setup must not be used by the rerun
+            if not useConfigManifest:       # with manifest the config is written by milleStep.sh, which also creates the run folder if needed
+                for job in jobs:
+                    createRunFolder(run,job[0],HG_bool)
+            writeMilleConfigs(run,HG_bool,jobs,configProcesses,manifestFile)     # write configs of all mille jobs
+            lumiFolders=set("lumi_"+str(job[0]) for job in jobs)
+            for dir_lumi in os.listdir(dirname_totalRun):      # remove log folders of mille jobs which are not part of the run anymore
+                if dir_lumi.startswith("lumi_") and dir_lumi not in lumiFolders:
+                    shutil.rmtree(dirname_totalRun+"/"+dir_lumi)
+        else:
+            if manifestStale:   # manifest is missing, but inputs did not change
+                writeMilleConfigs(run,HG_bool,jobs,configProcesses,manifestFile)
+            print "Run",run,"unchanged"
+        if not os.path.exists(getRunOutputFolder(run,HG_bool)+"/expectedJobs.txt"):    # used by pede step to check completion records of mille jobs
+            writeExpectedJobs(run,HG_bool,lumis)
+        if incrementalSetup and artifacts!=newArtifacts:
+            writeArtifactManifest(dirname_totalRun,newArtifacts)
+        runRecord={"run": int(run), "HG": bool(HG_bool), "logFolder": dirname_totalRun, "outputFolder": getRunOutputFolder(run,HG_bool), "lumis": lumis,
+                   "milleSubmitPerRun": milleSubmitPerRun, "configManifest": useConfigManifest, "jobs": jobs}
         if SingleRun:   # single runs are currently submitted right away
-            dugSubmit=writeDag(dirname_totalRun)
+            dugSubmit=writeDag(dirname_totalRun,runRecord)
             subprocess.call(["condor_submit_dag", "-f", dirname_totalRun+"/"+dugSubmit])
-        return True
+        return runRecord
     else:
         print "Not enough LumiSections"
-        return False
-
-print "!!!!!!Check if correct SG is loaded in the beginning and if study can be iterative (payloads already in output folder)!!!!!!!!"
-
-#########################2018B long range with template update#################################
-# set jsons for nominal and lowPU runs
-url = "https://test-eos-cms-service-dqm.web.cern.ch/test-eos-cms-service-dqm/CAF/certification/Collisions18/13TeV/DCSOnly/json_DCSONLY.txt"
-url_lowPU = "https://test-eos-cms-service-dqm.web.cern.ch/test-eos-cms-service-dqm/CAF/certification/Collisions18/13TeV/PromptReco/Cert_318939-319488_13TeV_PromptReco_SpecialCollisions18_JSON_LOWPU.txt"
-
-# open url
-response = urllib.urlopen(url)
-response_lowPU = urllib.urlopen(url_lowPU)
-
-# read json (and merge with lowPU)
-data = json.loads(response.read())
-data_lowPU = json.loads(response_lowPU.read())
-#  ~data = merge_two_dicts(data,data_lowPU)
-
-# get ordered dictionary with {run:"lumiRange1, lumiRange2"}
-data = collections.OrderedDict(sorted(data.items()))
-
-# define run range (different eras are usually run in different dag jobs)
-#Run2018B
-startingRun=317087
-#  ~stoppingRun=318877
-stoppingRun=317090
-#Run2018C
-#  ~startingRun=319337
-#  ~stoppingRun=320065
-#Run2018D partly
-#  ~startingRun=320500
-#  ~stoppingRun=321177
-
-#Across Run2018B and Run2018C (used for lowPU included study)
-#  ~startingRun=317626
-#  ~stoppingRun=319699
-
-# set helper variables
-longestRange=0
-totalLS=0
-startLongestRange=0
-
-# define the number of lumi sections to be used per run
-numberOfLS=100
-
-# loop over each run in the selected range
-for run in data:
-    if int(run)>=startingRun and int(run)<stoppingRun:
-        for lsRange in data[run]:   # loop to find the longest range of lumis and store its length
-            if lsRange[1]-lsRange[0]>longestRange: 
-                longestRange=lsRange[1]-lsRange[0]
-                startLongestRange=lsRange[0]
-            totalLS+=lsRange[1]-lsRange[0]
-        if longestRange>100:    # use run only if there is a lumi range with more an 100 LS
-            if startLongestRange<20:startLongestRange=20    # do not use the first 100 Lumis
-            #  ~submitRun(run,0,numberOfLS,5,startLongestRange,False)   # prepare LG with 5 lumis per mille job
-            submitRun(run,1,numberOfLS,5,startLongestRange,False)   #prepare HG with 5 lumis per mille job
-        longestRange=0      # set variables to zero for next run
-        totalLS=0
-
-# write dag submits for trends
-writeDag_Trend("/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/logs")
-#  ~writeDag_Trend("/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/logs_LG")
-
-#Getting payload for UL: conddb_import -f frontier://FrontierProd/CMS_CONDITIONS -i TrackerAlignment_v28_offline -c sqlite:file.db -b 317626 -e 317626 -t SiPixelAli_pcl
-#Getting payload for PR: conddb_import -f frontier://FrontierProd/CMS_CONDITIONS -i TrackerAlignment_PCL_byRun_v2_express -c sqlite:file.db -b 317080 -e 317080 -t SiPixelAli_pcl
-
-#load t0 setting: module load lxbatch/tzero
+        return None
+
+if __name__ == "__main__":
+    print "!!!!!!Check if correct SG is loaded in the beginning and if study can be iterative (payloads already in output folder)!!!!!!!!"
+
+    #########################2018B long range with template update#################################
+    # set jsons for nominal and lowPU runs
+    url = "https://test-eos-cms-service-dqm.web.cern.ch/test-eos-cms-service-dqm/CAF/certification/Collisions18/13TeV/DCSOnly/json_DCSONLY.txt"
+    url_lowPU = "https://test-eos-cms-service-dqm.web.cern.ch/test-eos-cms-service-dqm/CAF/certification/Collisions18/13TeV/PromptReco/Cert_318939-319488_13TeV_PromptReco_SpecialCollisions18_JSON_LOWPU.txt"
+
+    # open url
+    response = urllib.urlopen(url)
+    response_lowPU = urllib.urlopen(url_lowPU)
+
+    # read json (and merge with lowPU)
+    data = json.loads(response.read())
+    data_lowPU = json.loads(response_lowPU.read())
+    #  ~data = merge_two_dicts(data,data_lowPU)
+
+    # get ordered dictionary with {run:"lumiRange1, lumiRange2"}
+    data = collections.OrderedDict(sorted(data.items()))
+
+    # define run range (different eras are usually run in different dag jobs)
+    #Run2018B
+    startingRun=317087
+    #  ~stoppingRun=318877
+    stoppingRun=317090
+    #Run2018C
+    #  ~startingRun=319337
+    #  ~stoppingRun=320065
+    #Run2018D partly
+    #  ~startingRun=320500
+    #  ~stoppingRun=321177
+
+    #Across Run2018B and Run2018C (used for lowPU included study)
+    #  ~startingRun=317626
+    #  ~stoppingRun=319699
+
+    # set helper variables
+    longestRange=0
+    totalLS=0
+    startLongestRange=0
+
+    # define the number of lumi sections to be used per run
+    numberOfLS=100
+
+    # dictionary of selected runs in the form of {run: startLumi}
+    selectedRuns=collections.OrderedDict()
+
+    # loop over each run in the selected range
+    for run in data:
+        if int(run)>=startingRun and int(run)<stoppingRun:
+            for lsRange in data[run]:   # loop to find the longest range of lumis and store its length
+                if lsRange[1]-lsRange[0]>longestRange: 
+                    longestRange=lsRange[1]-lsRange[0]
+                    startLongestRange=lsRange[0]
+                totalLS+=lsRange[1]-lsRange[0]
+            if longestRange>100:    # use run only if there is a lumi range with more an 100 LS
+                if startLongestRange<20:startLongestRange=20    # do not use the first 100 Lumis
+                selectedRuns[run]=startLongestRange
+            longestRange=0      # set variables to zero for next run
+            totalLS=0
+
+    # write (or remove) the runtime environment snapshot and the pede template used by the jobs
+    prepareEnvSnapshot()
+    preparePedeTemplate(1)
+
+    # retrieve file lists of the selected runs with parallel das queries and prepare each run as soon as its file list is available
+    runRecords=[]
+    for run,fileDict in fetchFileLists(selectedRuns.keys()):
+        if fileDict is None:
+            print "Could not retrieve file list for run",run,"(skipped)"
+            continue
+        #  ~runRecord=submitRun(run,0,numberOfLS,5,selectedRuns[run],False,fileDict)   # prepare LG with 5 lumis per mille job
+        runRecord=submitRun(run,1,numberOfLS,5,selectedRuns[run],False,fileDict)   #prepare HG with 5 lumis per mille job
+        if runRecord: runRecords.append(runRecord)
+
+    # define input payload of each run if the payload store is used (startRun can be set to any run in the store to restart from this run)
+    if usePayloadStore:
+        writePayloadParents(runRecords,1)
+
+    # write dag submits for trends (splice=True writes one dag per run, which are included as splices, speculative=True starts mille jobs before the previous pede job finished and needs useConfigManifest=True)
+    # complete runs at the beginning of the trend are not part of the dag (skipComplete=False reruns all runs)
+    if writeDag_Trend("/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/logs",runRecords) is None:
+        print "All runs complete, no dag written"
+    #  ~writeDag_Resume("/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/logs")     # dag with only the unfinished work of the trend (without preparing the runs again)
+    #  ~writeDag_Trend("/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/logs_LG",runRecords)
+    
+    # show how many DAS queries were saved by the cache
+    printDasCacheStats()
+
+    #Getting payload for UL: conddb_import -f frontier://FrontierProd/CMS_CONDITIONS -i TrackerAlignment_v28_offline -c sqlite:file.db -b 317626 -e 317626 -t SiPixelAli_pcl
+    #Getting payload for PR: conddb_import -f frontier://FrontierProd/CMS_CONDITIONS -i TrackerAlignment_PCL_byRun_v2_express -c sqlite:file.db -b 317080 -e 317080 -t SiPixelAli_pcl
+
+    #load t0 setting: module load lxbatch/tzero
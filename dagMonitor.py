@@ -0,0 +1,296 @@
+#!/usr/bin/env python2
+# script to monitor a dag without querying the schedd: the node log of dagman (<dag>.nodes.log) and the logs of the mille and pede jobs (log_mille.log, log_pede.log) are read incrementally
+# (the byte offset of each log and the status of all jobs are stored in <dag>.monitor.json), shows the progress of each run, the job throughput, stragglers and an ETA along the critical path of the trend
+
+import argparse
+import collections
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# header of a job event in the form of "005 (1234.000.000) 2020-10-18 09:10:11 Job terminated." (older condor versions write the date as 10/18)
+eventPattern=re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.\d+\) (\S+ \S+) ")
+
+# method to get time of an event in seconds since epoch
+def parseEventTime(text):
+    try:
+        return time.mktime(time.strptime(text,"%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        return time.mktime(time.strptime(str(time.localtime().tm_year)+"/"+text,"%Y/%m/%d %H:%M:%S"))
+
+# method to get the nodes of a dag (including nodes of splices) in the form of {node: submit file}
+def readDagNodes(dagFile,prefix=""):
+    nodes=collections.OrderedDict()
+    with open(dagFile,"r") as f:
+        for line in f:
+            fields=line.split()
+            if len(fields)>=3 and fields[0]=="JOB":
+                nodes[prefix+fields[1]]=fields[2]
+            elif len(fields)>=3 and fields[0]=="SPLICE":
+                nodes.update(readDagNodes(fields[2],prefix+fields[1]+"+"))
+    return nodes
+
+# method to get the log file defined in a submit file
+def readSubmitLog(submitFile):
+    with open(submitFile,"r") as f:
+        for line in f:
+            if line.split("=")[0].strip().lower()=="log":
+                return line.split("=",1)[1].strip()
+    return None
+
+# method to get type (mille or pede), run and HG flag of a node from its submit file (e.g. logs/HG_run317087/lumi_20/submit_mille.sub)
+def getNodeInfo(submitFile):
+    run=re.search(r"run(\d+)",submitFile)
+    return {"type": "pede" if "pede" in os.path.basename(submitFile) else "mille",
+            "run": int(run.group(1)) if run else 0, "HG": "HG_run" in submitFile}
+
+# class keeping the status of all jobs of a dag, which is updated with the new events of the logs on each call of update
+class DagMonitor:
+    def __init__(self, dagFile):
+        self.dagFile = dagFile
+        self.stateFile = dagFile+".monitor.json"
+        self.nodes = readDagNodes(dagFile)
+        self.nodeInfo = dict((node,getNodeInfo(submitFile)) for node,submitFile in self.nodes.iteritems())
+        self.offsets = {}     # bytes already read of each log
+        self.jobs = {}        # status of each job in the form of {"cluster.proc": {"node","submit","start","end","returnValue","held"}}
+        if os.path.exists(self.stateFile):
+            with open(self.stateFile,"r") as f:
+                state=json.load(f)
+            if state.get("dagFile")==dagFile:
+                self.offsets = state["offsets"]
+                self.jobs = state["jobs"]
+        self.logNodes = collections.OrderedDict([(dagFile+".nodes.log",None)])    # logs to read with the node used if the event has no "DAG Node" line
+        for node,submitFile in self.nodes.iteritems():
+            logFile=readSubmitLog(submitFile) if os.path.exists(submitFile) else None
+            if logFile and logFile not in self.logNodes:
+                self.logNodes[logFile]=node
+
+    # method to store offsets and job status, so the next call only reads new events
+    def save(self):
+        with open(self.stateFile+".tmp","w") as f:
+            json.dump({"dagFile": self.dagFile, "offsets": self.offsets, "jobs": self.jobs},f)
+        os.rename(self.stateFile+".tmp",self.stateFile)
+
+    # method to read the new complete events of all logs (an event which is not yet completely written is read in the next call)
+    def update(self):
+        for logFile,defaultNode in self.logNodes.iteritems():
+            if not os.path.exists(logFile): continue
+            offset=self.offsets.get(logFile,0)
+            if os.path.getsize(logFile)<offset: offset=0    # log was replaced (e.g. rerun of the dag)
+            with open(logFile,"r") as f:
+                f.seek(offset)
+                text=f.read()
+            end=text.rfind("\n...\n")     # end of the last complete event
+            if end<0: continue
+            for event in text[:end+5].split("\n...\n"):
+                self.addEvent(event.strip("\n").splitlines(),defaultNode)
+            self.offsets[logFile]=offset+end+5
+
+    # method to update the status of a job with one event
+    def addEvent(self, lines, defaultNode):
+        header=eventPattern.match(lines[0]) if lines else None
+        if not header: return
+        code=header.group(1)
+        eventTime=parseEventTime(header.group(4))
+        job=self.jobs.setdefault(header.group(2)+"."+header.group(3),{"node": None, "submit": None, "start": None, "end": None, "returnValue": None, "held": False})
+        for line in lines[1:]:
+            if line.strip().startswith("DAG Node:"):
+                job["node"]=line.split(":",1)[1].strip()
+        if job["node"] is None: job["node"]=defaultNode
+        if code=="000":     # submitted
+            job["submit"]=eventTime
+        elif code=="001":   # executing
+            job["start"]=eventTime
+            job["held"]=False
+        elif code=="004":   # evicted, job is idle again
+            job["start"]=None
+        elif code=="005":   # terminated
+            job["end"]=eventTime
+            returnValue=re.search(r"return value (\d+)","\n".join(lines))
+            job["returnValue"]=int(returnValue.group(1)) if returnValue else -1
+        elif code=="009":   # aborted
+            job["end"]=eventTime
+            job["returnValue"]=-1
+        elif code=="012":   # held
+            job["held"]=True
+        elif code=="013":   # released
+            job["held"]=False
+
+    # method to get the status of each node ("done", "failed", "running", "held", "idle" or "waiting") based on its latest job, together with its latest job
+    def getNodeStatus(self):
+        latest={}
+        for jobId,job in self.jobs.iteritems():
+            node=job["node"]
+            if node not in self.nodes: continue
+            cluster,proc=(int(i) for i in jobId.split("."))
+            latest.setdefault(node,{}).setdefault(cluster,[]).append(job)
+        status={}
+        for node in self.nodes:
+            if node not in latest:
+                status[node]=("waiting",None)
+                continue
+            jobs=latest[node][max(latest[node])]    # jobs of the latest cluster (e.g. retry of the node)
+            if any(job["end"] is not None and job["returnValue"]!=0 for job in jobs): state="failed"
+            elif all(job["end"] is not None for job in jobs): state="done"
+            elif any(job["held"] for job in jobs): state="held"
+            elif any(job["start"] is not None and job["end"] is None for job in jobs): state="running"
+            else: state="idle"
+            status[node]=(state,min(jobs, key=lambda job: job["start"] or float("inf")))
+        return status
+
+    # method to get the median wall time of finished jobs of each type (mille, pede) in the form of {type: wall time}
+    def getMedianWallTimes(self, status):
+        wallTimes=collections.defaultdict(list)
+        for node,(state,job) in status.iteritems():
+            if state=="done" and job["start"] is not None:
+                wallTimes[self.nodeInfo[node]["type"]].append(job["end"]-job["start"])
+        return dict((jobType,sorted(values)[len(values)/2]) for jobType,values in wallTimes.iteritems())
+
+    # method to get the throughput of the dag in finished jobs per hour in the last hour and since the first job started
+    def getThroughput(self, now):
+        ends=[job["end"] for job in self.jobs.itervalues() if job["end"] is not None and job["returnValue"]==0]
+        starts=[job["start"] for job in self.jobs.itervalues() if job["start"] is not None]
+        recent=sum(1 for end in ends if end>now-3600)
+        overall=3600.*len(ends)/(now-min(starts)) if starts and now>min(starts) else 0.
+        return recent,overall
+
+    # method to get the running jobs taking longer than factor times the median wall time of finished jobs of the same type in the form of [(node, running time, median)]
+    def getStragglers(self, status, medians, now, factor=3.):
+        stragglers=[]
+        for node,(state,job) in status.iteritems():
+            median=medians.get(self.nodeInfo[node]["type"])
+            if state=="running" and median and now-job["start"]>factor*median:
+                stragglers.append((node,now-job["start"],median))
+        return sorted(stragglers, key=lambda straggler: -straggler[1])
+
+    # method to get the expected remaining time along the critical path of the trend (runs are processed one after another, mille jobs of a run in parallel)
+    # each open run needs the remaining time of its slowest mille job and of its pede job, based on the median wall times of finished jobs, returns None without finished mille and pede jobs
+    def getETA(self, status, medians, now):
+        if "mille" not in medians or "pede" not in medians: return None
+        eta=0.
+        for run,nodes in sorted(self.getRunNodes().items()):
+            remaining={"mille": 0., "pede": 0.}
+            for node in nodes:
+                state,job=status[node]
+                jobType=self.nodeInfo[node]["type"]
+                if state=="done": continue
+                elif state=="running": left=max(medians[jobType]-(now-job["start"]),0.)
+                else: left=medians[jobType]
+                remaining[jobType]=max(remaining[jobType],left)
+            eta+=remaining["mille"]+remaining["pede"]
+        return eta
+
+    # method to get the nodes of each run in the form of {(run, HG): [nodes]}
+    def getRunNodes(self):
+        runNodes=collections.OrderedDict()
+        for node in self.nodes:
+            info=self.nodeInfo[node]
+            runNodes.setdefault((info["run"],info["HG"]),[]).append(node)
+        return runNodes
+
+    # method to print progress of each run, throughput, stragglers and ETA
+    def printReport(self, now=None, stragglerFactor=3.):
+        if now is None: now=time.time()
+        status=self.getNodeStatus()
+        medians=self.getMedianWallTimes(status)
+        counts=collections.Counter(state for state,job in status.itervalues())
+        print time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(now)),self.dagFile
+        print "{} of {} nodes done, {} running, {} idle, {} held, {} failed, {} waiting".format(counts["done"],len(status),counts["running"],counts["idle"],counts["held"],counts["failed"],counts["waiting"])
+        print "{:<16} {:>12} {:>8}  {}".format("run","mille","pede","status")
+        for (run,HG),nodes in self.getRunNodes().iteritems():
+            runCounts=collections.Counter((self.nodeInfo[node]["type"],status[node][0]) for node in nodes)
+            nMille=sum(1 for node in nodes if self.nodeInfo[node]["type"]=="mille")
+            runStates=set(status[node][0] for node in nodes)
+            runState="failed" if "failed" in runStates else "done" if runStates=={"done"} else "waiting" if runStates=={"waiting"} else "running"
+            print "{:<16} {:>12} {:>8}  {}".format(("HG_" if HG else "")+"run"+str(run),"{}/{}".format(runCounts[("mille","done")],nMille),
+                                                   "{}/{}".format(runCounts[("pede","done")],len(nodes)-nMille),runState)
+        recent,overall=self.getThroughput(now)
+        print "Throughput: {} jobs in the last hour, {:.1f} jobs/h overall".format(recent,overall)
+        print "Median wall time: "+", ".join("{} {:.0f} min".format(jobType,median/60.) for jobType,median in sorted(medians.items()))
+        for node,runningTime,median in self.getStragglers(status,medians,now,stragglerFactor):
+            print "Straggler: {} running for {:.0f} min (median {:.0f} min)".format(node,runningTime/60.,median/60.)
+        eta=self.getETA(status,medians,now)
+        if eta is None:
+            print "ETA: not available before the first mille and pede jobs finished"
+        else:
+            print "ETA: {:.1f} h ({})".format(eta/3600.,time.strftime("%Y-%m-%d %H:%M",time.localtime(now+eta)))
+
+# method to get a synthetic job event in the format of the condor logs (with dag node line if node is given)
+def getSyntheticEvent(code, job, eventTime, text, node=None, lines=[]):
+    return "\n".join(["{} ({}.000.000) {} {}".format(code,job,eventTime,text)]+(["    DAG Node: "+node] if node else [])+lines+["...",""])
+
+# method to write a synthetic dag of two runs with its logs to a directory, returns path to the dag file
+# run 1 is complete (events in the node log of dagman), the mille job of run 2 is running (events only in log_mille.log of its submit) and its termination event is only partly written
+def writeSyntheticDag(dirname):
+    nodes = collections.OrderedDict([("mille_HG_run1_lumi_20","HG_run1/lumi_20/submit_mille.sub"), ("mille_HG_run1_lumi_25","HG_run1/lumi_25/submit_mille.sub"),
+                                     ("pedeStep_HG_run1","HG_run1/submit_pede.sub"), ("mille_HG_run2_lumi_20","HG_run2/lumi_20/submit_mille.sub"), ("pedeStep_HG_run2","HG_run2/submit_pede.sub")])
+    for node,submitFile in nodes.iteritems():
+        if not os.path.exists(os.path.join(dirname,os.path.dirname(submitFile))):
+            os.makedirs(os.path.join(dirname,os.path.dirname(submitFile)))
+        with open(os.path.join(dirname,submitFile),"w") as f:
+            f.write("Log        = {}/{}\n".format(os.path.join(dirname,os.path.dirname(submitFile)),"log_pede.log" if "pede" in node else "log_mille.log"))
+    dagFile = os.path.join(dirname,"dag_submit.dag")
+    with open(dagFile,"w") as f:
+        f.write("".join("JOB {} {}\n".format(node,os.path.join(dirname,submitFile)) for node,submitFile in nodes.iteritems()))
+    with open(dagFile+".nodes.log","w") as f:
+        for job,node,start,end in [(101,"mille_HG_run1_lumi_20","09:00","10:00"),(102,"mille_HG_run1_lumi_25","09:00","10:00"),(103,"pedeStep_HG_run1","10:00","10:30")]:
+            f.write(getSyntheticEvent("000",job,"2020-10-18 08:59:00","Job submitted from host: <127.0.0.1>",node))
+            f.write(getSyntheticEvent("001",job,"2020-10-18 "+start+":00","Job executing on host: <127.0.0.1>",node))
+            f.write(getSyntheticEvent("005",job,"2020-10-18 "+end+":00","Job terminated.",node,["    (1) Normal termination (return value 0)"]))
+    with open(os.path.join(dirname,"HG_run2/lumi_20/log_mille.log"),"w") as f:
+        f.write(getSyntheticEvent("000",104,"2020-10-18 10:30:00","Job submitted from host: <127.0.0.1>"))
+        f.write(getSyntheticEvent("001",104,"2020-10-18 10:30:00","Job executing on host: <127.0.0.1>"))
+        f.write("005 (104.000.000) 2020-10-18 11:30:00 Job terminated.\n")     # event written only partly
+    return dagFile
+
+# method to check update, getNodeStatus and getETA of DagMonitor on a synthetic dag (used by python dagMonitor.py --check), including the incremental reading of a partly written event
+def checkSyntheticDag():
+    dirname = tempfile.mkdtemp()
+    try:
+        dagFile = writeSyntheticDag(dirname)
+        now = parseEventTime("2020-10-18 11:00:00")
+        monitor = DagMonitor(dagFile)
+        monitor.update()
+        monitor.save()
+        status = monitor.getNodeStatus()
+        assert [status[node][0] for node in monitor.nodes]==["done","done","done","running","waiting"], status
+        assert monitor.getETA(status,monitor.getMedianWallTimes(status),now)==3600.     # remaining 30 min of mille job and 30 min of pede job of run 2
+        logFile = os.path.join(dirname,"HG_run2/lumi_20/log_mille.log")
+        assert monitor.offsets[logFile]==os.path.getsize(logFile)-len("005 (104.000.000) 2020-10-18 11:30:00 Job terminated.\n")   # partly written event is read in the next call
+        with open(logFile,"a") as f:
+            f.write("    (1) Normal termination (return value 0)\n...\n")
+        monitor = DagMonitor(dagFile)       # offsets and job status are taken from the state of the first call
+        monitor.update()
+        status = monitor.getNodeStatus()
+        assert [status[node][0] for node in monitor.nodes]==["done","done","done","done","waiting"], status
+        assert monitor.getETA(status,monitor.getMedianWallTimes(status),now)==1800.
+        assert monitor.offsets[logFile]==os.path.getsize(logFile)
+        assert len(monitor.jobs)==4
+    finally:
+        shutil.rmtree(dirname)
+    print "DagMonitor check passed"
+    return True
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description="Monitor a dag by reading the job logs (no condor_q)")
+    parser.add_argument("dagFile",nargs="?",default="logs/dag_submit.dag")
+    parser.add_argument("--follow",type=float,default=0,help="update the report every given number of seconds")
+    parser.add_argument("--stragglerFactor",type=float,default=3.,help="running jobs taking longer than this factor times the median of finished jobs are shown as stragglers")
+    parser.add_argument("--check",action="store_true",help="check the monitor on a synthetic dag with synthetic logs")
+    args=parser.parse_args()
+    
+    if args.check:
+        checkSyntheticDag()
+        raise SystemExit(0)
+
+    monitor=DagMonitor(args.dagFile)
+    while True:
+        monitor.update()
+        monitor.save()
+        monitor.printReport(stragglerFactor=args.stragglerFactor)
+        if args.follow<=0: break
+        time.sleep(args.follow)
+        print
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+# script to record wall time, exit code and bytes read and written for each stage of the mille and pede jobs (one json line per stage, used in milleStep.sh and pedeStep.sh)
+# and to summarize the records of a study per stage and per run (python jobTelemetry.py summary <output directory>)
+
+import argparse
+import collections
+import glob
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# shell wrapper running the command of a stage, which writes the I/O counters of the shell (including network reads, e.g. remote input files) to the file $TELEMETRY_IO after the command finished
+# the counters of a process include all children it has waited for, so they contain the complete I/O of the command and its subprocesses (the counters are read in a subshell, which is not counted itself)
+ioWrapper='"$@"; status=$?; echo "$(< /proc/$$/io)" > "$TELEMETRY_IO"; exit $status'
+
+# method to run the command of a stage, returns (exit code, bytes read, bytes written), the exit code is 127 if the command can not be started
+def runMeasured(command):
+    fd,ioFile=tempfile.mkstemp(prefix="telemetry_io_")
+    os.close(fd)
+    try:
+        try:
+            exitCode=subprocess.call(["bash","-c",ioWrapper,"runMeasured"]+command,env=dict(os.environ,TELEMETRY_IO=ioFile))
+        except OSError as e:
+            print "Could not run",command,":",e
+            return 127,0,0
+        with open(ioFile,"r") as f:
+            io=dict(line.split(":") for line in f if ":" in line)
+    finally:
+        os.remove(ioFile)
+    return exitCode,int(io.get("rchar",0)),int(io.get("wchar",0))
+
+# method to append one record to the telemetry file of a job
+def writeRecord(fileName,record):
+    dirname=os.path.dirname(fileName)
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:     # created by other job in the meantime
+            pass
+    with open(fileName,"a") as f:
+        f.write(json.dumps(record,sort_keys=True)+"\n")
+
+# method to get the record of a stage with the description of the job (attempt is the start time of the job, so reruns of a job appending to the same file can be told apart)
+def getRecord(args,stage,start,wallTime,exitCode,bytesRead,bytesWritten):
+    return {"job": args.job, "run": args.run, "HG": bool(args.HG), "lumi": args.lumi, "attempt": args.attempt, "host": socket.gethostname(), "stage": stage,
+            "start": start, "wallTime": round(wallTime,3), "exitCode": exitCode, "bytesRead": bytesRead, "bytesWritten": bytesWritten}
+
+# method to read all records of given telemetry files
+def readTelemetry(fileNames):
+    records=[]
+    for fileName in fileNames:
+        with open(fileName,"r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:      # incomplete line of a killed job
+                    pass
+    return records
+
+# method to get a percentile (0-100) of a list of values (nearest rank)
+def getPercentile(values,percentile):
+    values=sorted(values)
+    if not values: return 0.
+    return values[min(len(values)-1,max(0,int(math.ceil(percentile*len(values)/100.))-1))]
+
+# method to get the records of each job in the form of {(job, run, HG, lumi): [records]}
+def getJobs(records):
+    jobs=collections.defaultdict(list)
+    for record in records:
+        jobs[(record["job"],record["run"],record["HG"],record["lumi"])].append(record)
+    return jobs
+
+# method to get the records of the latest attempt of each job (a rerun of a job appends to the same file) in the form of {(job, run, HG, lumi): [records]}
+# records without attempt (written before it was recorded) are split into attempts at each setup stage
+def getLatestAttempts(records):
+    latest={}
+    for key,jobRecords in getJobs(records).iteritems():
+        attempts=collections.OrderedDict()
+        attempt=None
+        for record in sorted(jobRecords, key=lambda record: record["start"]):
+            if record.get("attempt") is not None:
+                attempt=record["attempt"]
+            elif attempt is None or record["stage"].startswith("setup"):
+                attempt=record["start"]
+            attempts.setdefault(attempt,[]).append(record)
+        latest[key]=attempts[max(attempts)]
+    return latest
+
+# method to get the critical path of each run (slowest mille job followed by the pede job, only latest attempt of each job) in the form of {(run, HG): (wall time, [stage records])}
+# since runs of a trend are processed one after another, the critical path of the study is the sum over the runs
+def getCriticalPaths(records):
+    paths={}
+    latest=getLatestAttempts(records)
+    for (job,run,HG,lumi),jobRecords in sorted(latest.items()):
+        if job!="mille": continue
+        wallTime=sum(record["wallTime"] for record in jobRecords)
+        if (run,HG) not in paths or wallTime>paths[(run,HG)][0]:
+            paths[(run,HG)]=(wallTime,jobRecords)
+    for (job,run,HG,lumi),jobRecords in latest.items():
+        if job!="pede": continue
+        wallTime,path=paths.get((run,HG),(0.,[]))
+        paths[(run,HG)]=(wallTime+sum(record["wallTime"] for record in jobRecords),path+jobRecords)
+    return paths
+
+# method to print wall time percentiles and I/O of each stage of a set of records
+def printStageSummary(records):
+    stages=collections.OrderedDict()
+    for record in sorted(records, key=lambda record: (record["job"]!="mille",record["start"])):
+        stages.setdefault((record["job"],record["stage"]),[]).append(record)
+    print "{:<20} {:>6} {:>10} {:>8} {:>8} {:>8} {:>8} {:>10} {:>10} {:>7}".format("stage","count","total[s]","p50[s]","p90[s]","p99[s]","max[s]","read[MB]","write[MB]","failed")
+    for (job,stage),stageRecords in stages.iteritems():
+        wallTimes=[record["wallTime"] for record in stageRecords]
+        print "{:<20} {:>6} {:>10.0f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>10.1f} {:>10.1f} {:>7}".format(
+            job+":"+stage,len(stageRecords),sum(wallTimes),getPercentile(wallTimes,50),getPercentile(wallTimes,90),getPercentile(wallTimes,99),max(wallTimes),
+            sum(record["bytesRead"] for record in stageRecords)/1e6,sum(record["bytesWritten"] for record in stageRecords)/1e6,
+            sum(1 for record in stageRecords if record["exitCode"]!=0))
+
+# method to print the breakdown of a study (per stage and per run) and its critical path
+def printSummary(records):
+    print "Stages of all jobs:"
+    printStageSummary(records)
+    paths=getCriticalPaths(records)
+    print
+    print "Critical path per run (slowest mille job and pede job):"
+    print "{:<16} {:>10}  {}".format("run","total[s]","stages[s]")
+    for (run,HG),(wallTime,path) in sorted(paths.items()):
+        print "{:<16} {:>10.0f}  {}".format(("HG_" if HG else "")+"run"+str(run),wallTime," ".join("{}:{}={:.0f}".format(record["job"],record["stage"],record["wallTime"]) for record in path))
+    print
+    print "Critical path of study: {:.0f} s over {} runs".format(sum(path[0] for path in paths.values()),len(paths))
+    criticalStages=collections.defaultdict(float)
+    for wallTime,path in paths.values():
+        for record in path:
+            criticalStages[record["job"]+":"+record["stage"]]+=record["wallTime"]
+    total=sum(criticalStages.values())
+    for stage,wallTime in sorted(criticalStages.items(), key=lambda item: -item[1]):
+        print "    {:<20} {:>10.0f} s ({:.1f}%)".format(stage,wallTime,100.*wallTime/total if total else 0.)
+
+if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description="Record and summarize per-stage telemetry of the mille and pede jobs")
+    parser.add_argument("--file",help="telemetry file of the job (json lines)")
+    parser.add_argument("--job",default="mille",help="type of the job (mille or pede)")
+    parser.add_argument("--run",type=int,default=0)
+    parser.add_argument("--HG",type=int,default=0)
+    parser.add_argument("--lumi",type=int,default=0)
+    parser.add_argument("--attempt",type=float,help="start time of the job (seconds since epoch), used to tell reruns of the job apart")
+    subparsers=parser.add_subparsers(dest="mode")
+    stageParser=subparsers.add_parser("stage",help="run command of a stage and record it (exit code of the command is returned)")
+    stageParser.add_argument("stage")
+    stageParser.add_argument("command",nargs=argparse.REMAINDER)
+    recordParser=subparsers.add_parser("record",help="record a stage run outside of this script")
+    recordParser.add_argument("stage")
+    recordParser.add_argument("start",type=float,help="start time of the stage (seconds since epoch)")
+    recordParser.add_argument("exitCode",type=int)
+    recordParser.add_argument("bytesRead",type=int,nargs="?",default=0)
+    recordParser.add_argument("bytesWritten",type=int,nargs="?",default=0)
+    summaryParser=subparsers.add_parser("summary",help="summarize telemetry of all runs in the given output directories")
+    summaryParser.add_argument("dirs",nargs="+")
+    args=parser.parse_args()
+
+    if args.mode=="stage":
+        start=time.time()
+        exitCode,bytesRead,bytesWritten=runMeasured(args.command)
+        writeRecord(args.file,getRecord(args,args.stage,start,time.time()-start,exitCode,bytesRead,bytesWritten))
+        sys.exit(exitCode)
+    elif args.mode=="record":
+        writeRecord(args.file,getRecord(args,args.stage,args.start,time.time()-args.start,args.exitCode,args.bytesRead,args.bytesWritten))
+    else:
+        printSummary(readTelemetry(sum((glob.glob(dirname+"/*run*/telemetry/*.jsonl") for dirname in args.dirs),[])))
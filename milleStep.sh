@@ -1,14 +1,26 @@
-#!/bin/bash 
+#!/bin/bash
 # script which takes care of running the mille step for the HG PCL studies
 # takes run number, boolean for HG running and start_lumi(only for proper folder/file names) as command line arguments
+# optional fourth argument "scratch" runs the mille step in the condor scratch directory and only copies the mille output to the output directory
 RunNo="$1"
 HG_bool=$2
 Start_Lumi=$3
+Mode=$4
 
-# source CMSSW (has to be changed for different user)
+# source CMSSW (has to be changed for different user), the environment snapshot written by createSubmitDAG.py is sourced instead of running scramv1 if it is newer than the scram setup of the release
 cmsswDir=/afs/cern.ch/user/d/dmeuser/alignment/PCL/hgPCL/CMSSW_11_1_0_pre3/src
-cd $cmsswDir
-eval `scramv1 runtime -sh`
+envSnapshot=/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/envSnapshot.sh
+setupStart=$(date +%s.%N)     # setup is recorded in the telemetry once the output directory is known (also used to tell reruns of the job apart)
+if [ -f $envSnapshot ] && [ -z "$(find $cmsswDir/../.SCRAM -newer $envSnapshot -print -quit 2>/dev/null)" ]
+then
+    setupStage=setupSnapshot
+    source $envSnapshot
+else
+    setupStage=setup
+    cd $cmsswDir
+    eval `scramv1 runtime -sh`
+fi
+setupStatus=$?
 
 # set home directory (has to be changed for different user)
 export HOME=/afs/cern.ch/user/d/dmeuser
@@ -23,43 +35,137 @@ cafPath=/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/output
 # set path to working space (has to be changed for different user)
 workPath=/afs/cern.ch/work/d/dmeuser/alignment/PCL/condor_PCL_2018/run_directories
 
+# method to copy a file and verify size and checksum of the copy, the copy is only renamed to its final name if it is complete (takes source and destination as arguments)
+copyVerified() {
+    for attempt in 1 2 3
+    do
+        cp $1 $2.tmp
+        if [ "$(stat -c %s $1)" == "$(stat -c %s $2.tmp 2>/dev/null)" ] && [ "$(cksum < $1)" == "$(cksum < $2.tmp 2>/dev/null)" ]
+        then
+            mv $2.tmp $2
+            return 0
+        fi
+        echo "Copy of $1 to $2 failed (attempt $attempt)"
+        rm -f $2.tmp
+        sleep 10
+    done
+    return 1
+}
+
+# method to publish the completion record of the mille job (completed/lumi_N.json in output directory of the run), which is used by the pede step to select the complete outputs
+# takes local mille output, name of the output in the output directory of the run and wall time of cmsRun as arguments
+writeCompletionRecord() {
+    recordDir=$cafPath/$runName/completed
+    mkdir $recordDir -p
+    nEvents=$(edmFileUtil file:$1 2>/dev/null | grep -o "[0-9]* events" | head -1 | cut -d" " -f1)
+    echo "{\"lumi\": $Start_Lumi, \"file\": \"$2\", \"size\": $(stat -c %s $1), \"checksum\": \"$(cksum < $1 | cut -d" " -f1)\", \"events\": ${nEvents:--1}, \"wallTime\": $3}" > $recordDir/lumi_$Start_Lumi.json.tmp
+    mv $recordDir/lumi_$Start_Lumi.json.tmp $recordDir/lumi_$Start_Lumi.json
+}
+
+# method to copy the input payload snapshot of the run to the current directory if the payload store is used (payloadParent.txt written by createSubmitDAG.py)
+fetchPayload() {
+    if [ -f $cafPath/$runName/payloadParent.txt ]
+    then
+        runStage payload python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; sys.exit(createSubmitDAG.fetchPayloadSnapshot($HG_bool,'$cafPath/$runName','payloads.db'))" || exit 1
+    fi
+}
+
+# method to run a stage of the job and append its wall time, exit code and bytes read and written to the telemetry of the job (takes stage name and command as arguments)
+runStage() {
+    python $baseDir/jobTelemetry.py --file $telemetryFile --job mille --run $RunNo --HG $HG_bool --lumi $Start_Lumi --attempt $setupStart stage "$@"
+}
+
+# method to append a stage which was not run by runStage to the telemetry of the job (takes stage name, start time, exit code, bytes read and bytes written as arguments)
+recordStage() {
+    python $baseDir/jobTelemetry.py --file $telemetryFile --job mille --run $RunNo --HG $HG_bool --lumi $Start_Lumi --attempt $setupStart record "$@"
+}
+
 # check if running HG or LG
 if [ $HG_bool -eq 1 ]
 then
     echo "Running with HG"
-    
-    # prepare output directory
-    outputDir=$cafPath/HG_run$RunNo/lumi_$Start_Lumi
-    mkdir $outputDir -p
-    
-    # define running directory (should already exist due to running createSubmitDAG.py)
-    runDir=$workPath/HG_run$RunNo/lumi_$Start_Lumi
-    cd $runDir
-    
-    # run mille step in run directory (py script already produced in createSubmitDAG.py)
-    cmsRun milleStep_ALCA_HG.py
+    runName=HG_run$RunNo
+    configName=milleStep_ALCA_HG.py
+    manifest=$baseDir/logs/$runName/milleConfigs.json
 else
     echo "Running with nominal granularity"
-    
-    # prepare output directory
-    outputDir=$cafPath/run$RunNo/lumi_$Start_Lumi
-    mkdir $outputDir -p
-    
-    # define running directory (should already exist due to running createSubmitDAG.py)
-    runDir=$workPaths/run$RunNo/lumi_$Start_Lumi
-    cd $runDir
-    
-    # run mille step in run directory (py script already produced in createSubmitDAG.py)
-    cmsRun milleStep_ALCA.py
+    runName=run$RunNo
+    configName=milleStep_ALCA.py
+    manifest=$baseDir/logs_LG/$runName/milleConfigs.json
 fi
 
+# define running directory (should already exist due to running createSubmitDAG.py)
+runDir=$workPath/$runName/lumi_$Start_Lumi
+
+# define telemetry file of the job (summarized with "python jobTelemetry.py summary $cafPath")
+telemetryFile=$cafPath/$runName/telemetry/mille_$Start_Lumi.jsonl
+recordStage $setupStage $setupStart $setupStatus
+
+if [ "$Mode" == "scratch" ]
+then
+    echo "Running in condor scratch directory"
+
+    # write config to scratch directory from manifest of the run (or take config from run directory if configs were written for each job)
+    cd $_CONDOR_SCRATCH_DIR
+    if [ -f $manifest ]
+    then
+        runStage config python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; createSubmitDAG.writeConfigFromManifest('$manifest',$Start_Lumi,'$configName')"
+    else
+        cp $runDir/$configName .
+    fi
+    fetchPayload
+
+    # run mille step in scratch directory
+    startTime=$SECONDS
+    runStage cmsRun cmsRun $configName || exit $?
+    wallTime=$((SECONDS-startTime))
+
+    # copy only mille output to output directory of the run (used in the pede step), everything else is removed with the scratch directory
+    mkdir $cafPath/$runName -p
+    copyStart=$(date +%s.%N)
+    copyVerified PromptCalibProdSiPixelAli.root $cafPath/$runName/PromptCalibProdSiPixelAli_$Start_Lumi.root
+    copyStatus=$?
+    outputSize=$(stat -c %s PromptCalibProdSiPixelAli.root)
+    recordStage stageOut $copyStart $copyStatus $outputSize $outputSize
+    [ $copyStatus -eq 0 ] || exit 1
+    writeCompletionRecord PromptCalibProdSiPixelAli.root PromptCalibProdSiPixelAli_$Start_Lumi.root $wallTime
+    exit 0
+fi
+
+# prepare output directory
+outputDir=$cafPath/$runName/lumi_$Start_Lumi
+mkdir $outputDir -p
+
+mkdir $runDir -p    # run directory is removed after each job, so it has to be recreated if the job is rerun
+cd $runDir
+
+# write config from manifest of the run if configs were not written for each job (useConfigManifest in createSubmitDAG.py)
+if [ ! -f $configName ] && [ -f $manifest ]
+then
+    runStage config python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; createSubmitDAG.writeConfigFromManifest('$manifest',$Start_Lumi,'$configName')"
+fi
+
+# run mille step in run directory (py script already produced in createSubmitDAG.py)
+fetchPayload
+startTime=$SECONDS
+runStage cmsRun cmsRun $configName
+cmsStatus=$?
+wallTime=$((SECONDS-startTime))
+rm -f payloads.db      # local copy of payload snapshot is not needed in output directory
+
 # move everything from running directory to output directory (mille step is not working on eos/caf)
-mv $runDir/* $outputDir
+runStage stageOut mv $runDir/* $outputDir
 
 # rename and move mille step output to be able to use it in the pede step
 cd $outputDir
 mv PromptCalibProdSiPixelAli.root PromptCalibProdSiPixelAli_$Start_Lumi.root
-cp PromptCalibProdSiPixelAli_$Start_Lumi.root ../
+runStage copyOutput cp PromptCalibProdSiPixelAli_$Start_Lumi.root ../
+
+# publish completion record only if mille step was successful
+if [ $cmsStatus -eq 0 ]
+then
+    writeCompletionRecord PromptCalibProdSiPixelAli_$Start_Lumi.root PromptCalibProdSiPixelAli_$Start_Lumi.root $wallTime
+fi
 
 # go back to base directory
 cd $baseDir
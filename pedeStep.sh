@@ -4,14 +4,70 @@
 RunNo="$1"
 HG_bool=$2
 
-# source CMSSW (has to be changed for different user)
+# source CMSSW (has to be changed for different user), the environment snapshot written by createSubmitDAG.py is sourced instead of running scramv1 if it is newer than the scram setup of the release
 cmsswDir=/afs/cern.ch/user/d/dmeuser/alignment/PCL/hgPCL/CMSSW_11_1_0_pre3/src
-cd $cmsswDir
-eval `scramv1 runtime -sh`
+envSnapshot=/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018/envSnapshot.sh
+setupStart=$(date +%s.%N)     # setup is recorded in the telemetry once the output directory is known (also used to tell reruns of the job apart)
+if [ -f $envSnapshot ] && [ -z "$(find $cmsswDir/../.SCRAM -newer $envSnapshot -print -quit 2>/dev/null)" ]
+then
+    setupStage=setupSnapshot
+    source $envSnapshot
+else
+    setupStage=setup
+    cd $cmsswDir
+    eval `scramv1 runtime -sh`
+fi
+setupStatus=$?
+
+# set base directory (has to be changed for different user)
+baseDir=/afs/cern.ch/user/d/dmeuser/alignment/PCL/condor_PCL_2018
 
 # set path to CAF (has to be changed for different user)
 cafPath=/eos/cms/store/caf/user/dmeuser/PCL/condor_PCL_2018/output
 
+# method to run a stage of the job and append its wall time, exit code and bytes read and written to the telemetry of the job (takes stage name and command as arguments)
+runStage() {
+    python $baseDir/jobTelemetry.py --file $outputDir/telemetry/pede.jsonl --job pede --run $RunNo --HG $HG_bool --attempt $setupStart stage "$@"
+}
+
+# method to append a stage which was not run by runStage to the telemetry of the job (takes stage name, start time, exit code, bytes read and bytes written as arguments)
+recordStage() {
+    python $baseDir/jobTelemetry.py --file $outputDir/telemetry/pede.jsonl --job pede --run $RunNo --HG $HG_bool --attempt $setupStart record "$@"
+}
+
+# method to copy the input payload snapshot of the run to the condor scratch directory if the payload store is used (payloadParent.txt written by createSubmitDAG.py)
+fetchPayload() {
+    if [ -f payloadParent.txt ]
+    then
+        payloadDB=$_CONDOR_SCRATCH_DIR/payloads.db
+        runStage payload python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; sys.exit(createSubmitDAG.fetchPayloadSnapshot($HG_bool,'$outputDir','$payloadDB'))" || exit 1
+    fi
+}
+
+# method to import the new alignment to the db file (payloadUpdated marks that a new payload was imported, used by checkPayloadUpdate.sh)
+# if the pede step finished without writing a payload, payloadUnchanged is written instead, so the resume planner can tell this apart from a failed import
+importPayload() {
+    rm -f payloadUpdated payloadUnchanged pedeCompleted
+    python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; sys.exit(createSubmitDAG.hasPayload('promptCalibConditions.db'))"
+    payloadStatus=$?
+    if [ $pedeStatus -eq 0 ] && [ $payloadStatus -eq 99 ]
+    then
+        echo "no Update produced"
+        touch payloadUnchanged
+    else
+        runStage import conddb_import -f sqlite:promptCalibConditions.db -c sqlite:$payloadDB -i SiPixelAli_pcl && touch payloadUpdated || echo "import of new payload failed"
+    fi
+}
+
+# method to store the payload after the import as snapshot of the run if the payload store is used (nothing is stored if the import failed)
+publishPayload() {
+    if [ -f payloadParent.txt ] && ( [ -f payloadUpdated ] || [ -f payloadUnchanged ] )
+    then
+        if [ -f payloadUpdated ]; then updated=True; else updated=False; fi
+        runStage publish python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; sys.exit(createSubmitDAG.publishRunPayload($HG_bool,$RunNo,'$payloadDB',$updated))" || exit 1
+    fi
+}
+
 # check if running HG or LG
 if [ $HG_bool -eq 1 ]
 then
@@ -19,30 +75,71 @@ then
     echo "Running with HG"
     outputDir=$cafPath/HG_run$RunNo
     cd $outputDir
+    recordStage $setupStage $setupStart $setupStatus
+    
+    # put all input files name for pede step to txt file (taken from completion records of the expected mille jobs if available)
+    if [ -f expectedJobs.txt ]
+    then
+        runStage fileList python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; sys.exit(createSubmitDAG.writeAlcaFileList('$outputDir'))" || exit 1
+    else
+        ls PromptCalibProdSiPixelAli_*.root | sed 's/Prompt/file:Prompt/g' > AlcaFiles.txt
+    fi
     
-    # put all input files name for pede step to txt file
-    ls PromptCalibProdSiPixelAli_*.root | sed 's/Prompt/file:Prompt/g' > AlcaFiles.txt
+    # take input payload from payloads_HG.db or from the snapshot of the previous run if the payload store is used
+    payloadDB=$cafPath/payloads_HG.db
+    fetchPayload
     
     # run pede step with HGprocess modifier, adapted thresholds using alignment from previous run (stored in payloads_HG.db)
-    cmsDriver.py pedeStep --data --conditions 106X_dataRun3_Express_v2 --scenario pp --era Run2_2018 -s ALCAHARVEST:SiPixelAli --filein filelist:AlcaFiles.txt --procModifiers high_granularity_pcl --customise_commands "process.GlobalTag.toGet = cms.VPSet(cms.PSet(record = cms.string('AlignPCLThresholdsRcd'),tag = cms.string('PCLThresholds_express_v0'),connect = cms.string('sqlite_file:$cmsswDir/CondFormats/PCLConfig/test/mythresholds_test.db')),cms.PSet(record = cms.string('TrackerAlignmentRcd'),tag = cms.string('SiPixelAli_pcl'),connect = cms.string('sqlite_file:$cafPath/payloads_HG.db')))"
+    if [ -f $baseDir/logs/pedeStep_ALCA_HG.py ]      # config rendered from pede template of the study (usePedeTemplate in createSubmitDAG.py)
+    then
+        runStage config python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; createSubmitDAG.writePedeConfig('$baseDir/logs/pedeStep_ALCA_HG.py','AlcaFiles.txt','$payloadDB','pedeStep_ALCAHARVEST.py')" || exit 1
+        runStage cmsRun cmsRun pedeStep_ALCAHARVEST.py
+    else
+        runStage cmsDriver cmsDriver.py pedeStep --data --conditions 106X_dataRun3_Express_v2 --scenario pp --era Run2_2018 -s ALCAHARVEST:SiPixelAli --filein filelist:AlcaFiles.txt --python_filename pedeStep_ALCAHARVEST.py --no_exec --procModifiers high_granularity_pcl --customise_commands "process.GlobalTag.toGet = cms.VPSet(cms.PSet(record = cms.string('AlignPCLThresholdsRcd'),tag = cms.string('PCLThresholds_express_v0'),connect = cms.string('sqlite_file:$cmsswDir/CondFormats/PCLConfig/test/mythresholds_test.db')),cms.PSet(record = cms.string('TrackerAlignmentRcd'),tag = cms.string('SiPixelAli_pcl'),connect = cms.string('sqlite_file:$payloadDB')))" && \
+        runStage cmsRun cmsRun pedeStep_ALCAHARVEST.py
+    fi
+    pedeStatus=$?
     
-    # import new alignment to db file
-    conddb_import -f sqlite:promptCalibConditions.db -c sqlite:../payloads_HG.db -i SiPixelAli_pcl || echo "no Update produced"
+    # import new alignment to db file and store it in the payload store
+    importPayload
+    publishPayload
 else
     # go to correct output directory
     echo "Running with nominal granularity"
     outputDir=$cafPath/run$RunNo
     cd $outputDir
+    recordStage $setupStage $setupStart $setupStatus
     
-    # put all input files name for pede step to txt file
-    ls PromptCalibProdSiPixelAli_*.root | sed 's/Prompt/file:Prompt/g' > AlcaFiles.txt
+    # put all input files name for pede step to txt file (taken from completion records of the expected mille jobs if available)
+    if [ -f expectedJobs.txt ]
+    then
+        runStage fileList python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; sys.exit(createSubmitDAG.writeAlcaFileList('$outputDir'))" || exit 1
+    else
+        ls PromptCalibProdSiPixelAli_*.root | sed 's/Prompt/file:Prompt/g' > AlcaFiles.txt
+    fi
+    
+    # take input payload from payloads.db or from the snapshot of the previous run if the payload store is used
+    payloadDB=$cafPath/payloads.db
+    fetchPayload
     
     # run pede step using alignment from previous run (stored in payloads_HG.db)
-    cmsDriver.py pedeStep --data --conditions 106X_dataRun3_Express_v2 --scenario pp --era Run2_2018 -s ALCAHARVEST:SiPixelAli --filein filelist:AlcaFiles.txt --customise_commands "process.GlobalTag.toGet = cms.VPSet(cms.PSet(record = cms.string('AlignPCLThresholdsRcd'),tag = cms.string('PCLThresholds_express_v0'),connect = cms.string('sqlite_file:$cmsswDir/CondFormats/PCLConfig/test/mythresholds.db')),cms.PSet(record = cms.string('TrackerAlignmentRcd'),tag = cms.string('SiPixelAli_pcl'),connect = cms.string('sqlite_file:$cafPath/payloads.db')))"
+    if [ -f $baseDir/logs_LG/pedeStep_ALCA.py ]      # config rendered from pede template of the study (usePedeTemplate in createSubmitDAG.py)
+    then
+        runStage config python -c "import sys; sys.path.insert(0,'$baseDir'); import createSubmitDAG; createSubmitDAG.writePedeConfig('$baseDir/logs_LG/pedeStep_ALCA.py','AlcaFiles.txt','$payloadDB','pedeStep_ALCAHARVEST.py')" || exit 1
+        runStage cmsRun cmsRun pedeStep_ALCAHARVEST.py
+    else
+        runStage cmsDriver cmsDriver.py pedeStep --data --conditions 106X_dataRun3_Express_v2 --scenario pp --era Run2_2018 -s ALCAHARVEST:SiPixelAli --filein filelist:AlcaFiles.txt --python_filename pedeStep_ALCAHARVEST.py --no_exec --customise_commands "process.GlobalTag.toGet = cms.VPSet(cms.PSet(record = cms.string('AlignPCLThresholdsRcd'),tag = cms.string('PCLThresholds_express_v0'),connect = cms.string('sqlite_file:$cmsswDir/CondFormats/PCLConfig/test/mythresholds.db')),cms.PSet(record = cms.string('TrackerAlignmentRcd'),tag = cms.string('SiPixelAli_pcl'),connect = cms.string('sqlite_file:$payloadDB')))" && \
+        runStage cmsRun cmsRun pedeStep_ALCAHARVEST.py
+    fi
+    pedeStatus=$?
     
-    # import new alignment to db file
-    conddb_import -f sqlite:promptCalibConditions.db -c sqlite:../payloads.db -i SiPixelAli_pcl || echo "no Update produced"
+    # import new alignment to db file and store it in the payload store
+    importPayload
+    publishPayload
 fi
 
-
-
+# mark successful pede step (used by the resume planner in createSubmitDAG.py)
+if [ $pedeStatus -eq 0 ]
+then
+    touch pedeCompleted
+fi
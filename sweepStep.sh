@@ -0,0 +1,27 @@
+#!/bin/bash
+# script which runs one point of the thread sweep prepared by writeThreadSweep in createSubmitDAG.py
+# takes folder of the sweep point and number of threads as command line arguments
+sweepDir="$1"
+nThreads=$2
+
+# source CMSSW (has to be changed for different user)
+cmsswDir=/afs/cern.ch/user/d/dmeuser/alignment/PCL/hgPCL/CMSSW_11_1_0_pre3/src
+cd $cmsswDir
+eval `scramv1 runtime -sh`
+
+# set home directory (has to be changed for different user)
+export HOME=/afs/cern.ch/user/d/dmeuser
+
+# run mille step in condor scratch directory
+cd $_CONDOR_SCRATCH_DIR
+cp $sweepDir/milleStep.py .
+startTime=$SECONDS
+cmsRun milleStep.py > cmsRun.log 2>&1
+cmsStatus=$?
+wallTime=$((SECONDS-startTime))
+tail -n 100 cmsRun.log
+
+# write result of sweep point (number of processed events taken from summary of cmsRun)
+nEvents=$(grep -o "Events total = [0-9]*" cmsRun.log | head -1 | grep -o "[0-9]*$")
+echo "{\"threads\": $nThreads, \"events\": ${nEvents:-0}, \"wallTime\": $wallTime, \"exitCode\": $cmsStatus}" > $sweepDir/result.json
+exit $cmsStatus